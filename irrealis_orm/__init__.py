@@ -2,28 +2,265 @@
 Tool to quickly setup SQLAlchemy object relation mappings that uses reflection
 to autoload table information from existing databases.
 '''
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
+import copy, csv, multiprocessing, os, re, sys, threading, time
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import groupby, islice
+
+from sqlalchemy import bindparam, create_engine, event, func, select, tuple_
+from sqlalchemy.exc import DisconnectionError, IntegrityError
+from sqlalchemy.orm import Query, RelationshipProperty, class_mapper, scoped_session, selectinload, sessionmaker
+from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy import Table, inspect
+from irrealis_orm.batch import WriteBehindBuffer
+from irrealis_orm.cache import KeyCache
+from irrealis_orm.routing import ReplicaRouter, RoutingSession
+from irrealis_orm.stats import QueryStats
+from irrealis_orm.reflection import (
+  LazyMetaData, PreloadedReflection, copy_table, load_reflection_cache,
+  reflect_parallel, save_reflection_cache, schema_fingerprint,
+  table_signatures,
+)
+
+# Relationship loading strategies that orm_defs may name in "__loading__".
+LOADING_STRATEGIES = ("select", "selectin", "joined", "subquery", "raise", "raise_on_sql")
+
+try: string_types = (str, unicode)
+except NameError: string_types = (str,)
+
+def _with_loading(prop, strategy):
+    '''
+    Internal function returning a copy of relationship property prop, loaded by
+    given strategy as if made by relationship(..., lazy=strategy), leaving prop
+    alone, since it belongs to the caller's orm_defs.
+    '''
+    prop = copy.copy(prop)
+    # Collections, such as info, mustn't be shared with the original.
+    for key, value in list(vars(prop).items()):
+      if isinstance(value, (dict, list, set)): setattr(prop, key, copy.copy(value))
+    # RelationshipProperty derives its strategy key from lazy when made.
+    prop.lazy = strategy
+    prop.strategy_key = (("lazy", strategy),)
+    return prop
+
+def _rebuild_orm(cls, orm_defs, url, options):
+    '''
+    Internal function rebuilding a pickled ORM from each orm_defs it was
+    given, in turn, its database url, and its options.
+    '''
+    orm = cls(**options)
+    for defs in orm_defs: orm.create_mapped_classes(defs)
+    if url is not None: orm.create_engine(url)
+    return orm
+
+def _begin_before_sqlite_savepoint(connection, name):
+    '''
+    Internal listener beginning SQLite transactions before SAVEPOINTs. pysqlite
+    and aiosqlite only send BEGIN before data-changing statements, so a
+    SAVEPOINT outside a transaction would begin one of its own, and releasing
+    the SAVEPOINT would commit for good, out of reach of a later rollback.
+    '''
+    dbapi_connection = connection.connection.dbapi_connection
+    # aiosqlite's adapter keeps the transaction state on the aiosqlite connection.
+    driver_connection = getattr(dbapi_connection, "_connection", dbapi_connection)
+    if not driver_connection.in_transaction:
+      # Like the drivers' own BEGIN, this isn't a statement for listeners.
+      cursor = dbapi_connection.cursor()
+      cursor.execute("BEGIN")
+      cursor.close()
+
+def _record_pid(dbapi_connection, connection_record):
+    '''Internal "connect" listener recording the process making a connection.'''
+    connection_record.info["irrealis_orm.pid"] = os.getpid()
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    '''
+    Internal "checkout" listener discarding pooled connections made by another
+    process, such as the parent of a forked process, so the pool makes a new
+    one. The parent's connection is left open for the parent.
+    '''
+    pid = connection_record.info.setdefault("irrealis_orm.pid", os.getpid())
+    if pid != os.getpid():
+      connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+      raise DisconnectionError("Connection made by process {} checked out by process {}.".format(pid, os.getpid()))
+
+def _guard_pool(engine):
+    '''
+    Internal function keeping processes forked from this one from using
+    connections pooled by engine, however the engine is used.
+    '''
+    for name, listener in (("connect", _record_pid), ("checkout", _check_pid)):
+      if not event.contains(engine, name, listener): event.listen(engine, name, listener)
+
+# Relationship arguments that may name other mapped classes.
+RELATIONSHIP_ARGUMENTS = ("argument", "secondary", "primaryjoin", "secondaryjoin", "order_by", "remote_side", "_user_defined_foreign_keys")
+
+class LazyMappedClasses(dict):
+    '''
+    Mapped classes of an ORM by table name, which builds classes defined
+    lazily, by ORM(..., lazy_classes=True), the first time they are looked up
+    by key. "in" only finds classes already built.
+    '''
+    def __init__(self, orm):
+        super(LazyMappedClasses, self).__init__()
+        self._orm = orm
+
+    def __missing__(self, key):
+        name = self._orm._class_tables.get(key)
+        if name is None: raise KeyError(key)
+        with self._orm._class_lock:
+          # Another thread may have built the class meanwhile.
+          if not dict.__contains__(self, key): self._orm._build_classes(name)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default = None):
+        try:
+          return self[key]
+        except KeyError:
+          return default
+
+# The ORM of a map_partitions(...) worker process.
+_worker_orm = None
+
+def _init_worker(orm):
+    '''Internal function setting the ORM of a map_partitions(...) worker process.'''
+    global _worker_orm
+    _worker_orm = orm
+
+def _map_partition(task):
+    '''Internal function calling a map_partitions(...) function for one partition.'''
+    name, key, start, stop, keyword_args, function = task
+    orm = _worker_orm
+    mapped_class = getattr(orm, name)
+    attribute = getattr(mapped_class, key)
+    q = orm.session.query(mapped_class).filter(attribute >= start, attribute < stop)
+    for keyword, argument in keyword_args.items():
+      q = q.filter(getattr(mapped_class, keyword)==argument)
+    try:
+      result = function(orm, q.order_by(attribute).all())
+      orm.session.commit()
+      return result
+    finally:
+      orm.remove_session()
 
 class ORM(object):
     '''Sets up SQLAlchemy object relational mappings.'''
 
-    def __mapped_class(self, name, Base, dct):
+    def __mapped_class(self, name, Base, dct, attach = True):
         '''
         Creates class of given name, inheriting from Base, with attributes
-        defined in dct. Attaches class to this ORM instance as attributes with
-        same name.
+        defined in dct, and returns it. Attaches class to this ORM instance as
+        attributes with same name, unless attach is False.
         '''
-        setattr(self, name, type(name, (Base,), dct))
+        dct = dict(dct)
+        for key, strategy in dct.pop("__loading__", dict()).items():
+          if not isinstance(dct.get(key), RelationshipProperty):
+            raise AttributeError("Cannot set loading strategy: '{}' ORM objects have no relationship '{}'.".format(name, key))
+          if strategy not in LOADING_STRATEGIES:
+            raise ValueError("Unknown loading strategy '{}' for '{}.{}'; expected one of {}.".format(strategy, name, key, ", ".join(LOADING_STRATEGIES)))
+          dct[key] = _with_loading(dct[key], strategy)
+        mapped_class = type(name, (Base,), dct)
+        if attach: self.__attach_class(name, mapped_class)
+        return mapped_class
+
+    def __attach_class(self, name, mapped_class):
+        '''Attaches mapped class to this ORM instance as attribute with given name.'''
+        setattr(self, name, mapped_class)
         # Save mapped classes for future reference.
-        self.mapped_classes[dct["__tablename__"]] = getattr(self, name)
+        self.mapped_classes[mapped_class.__tablename__] = mapped_class
+
+    def _class_dependencies(self, dct):
+        '''
+        Internal function returning the names of lazily defined classes that
+        relationships in class dict dct refer to.
+        '''
+        names = set()
+        for value in dct.values():
+          if not isinstance(value, RelationshipProperty): continue
+          for attribute in RELATIONSHIP_ARGUMENTS:
+            argument = getattr(value, attribute, None)
+            if isinstance(argument, string_types):
+              names.update(word for word in re.findall(r"\w+", argument) if word in self._class_defs)
+        return names
+
+    def _build_classes(self, name):
+        '''
+        Internal function building the lazily defined class of given name,
+        along with lazily defined classes its relationships depend on, and
+        mapping them if the ORM has an engine. Classes are only attached to
+        the ORM once mapped, so other threads never see them half-built.
+        '''
+        with self._class_lock:
+          names, pending = list(), [name]
+          while pending:
+            dependency = pending.pop()
+            if dependency in self._class_defs and dependency not in names:
+              names.append(dependency)
+              pending.extend(self._class_dependencies(self._class_defs[dependency]))
+          built = list()
+          for dependency in names:
+            dct = dict(self._class_defs.pop(dependency))
+            if "__table__" not in dct:
+              # The table may have been loaded already, unmapped.
+              table_args = dct.get("__table_args__", ())
+              if isinstance(table_args, dict): table_args = dict(table_args, extend_existing = True)
+              elif table_args and isinstance(table_args[-1], dict): table_args = tuple(table_args[:-1]) + (dict(table_args[-1], extend_existing = True),)
+              else: table_args = tuple(table_args) + (dict(extend_existing = True),)
+              dct["__table_args__"] = table_args
+            built.append(self.__mapped_class(dependency, self.Base, dct, attach = False))
+          if hasattr(self, "engine"):
+            if self.def_refl: self.Base.prepare(self.engine)
+            else: self.Base.metadata.create_all(self.engine, tables = [mapped_class.__table__ for mapped_class in built])
+          for dependency, mapped_class in zip(names, built): self.__attach_class(dependency, mapped_class)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found otherwise, such as lazily
+        # defined classes not yet built.
+        if name in self.__dict__.get("_lazy_names", ()):
+          with self._class_lock:
+            # Another thread may have built the class meanwhile.
+            if name not in self.__dict__: self._build_classes(name)
+          return self.__dict__[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
 
     def create_mapped_classes(self, orm_defs):
         '''
         Creates and maps the ORM classes specified in orm_defs.
+
+        A class's dict may name default loading strategies for its
+        relationships in "__loading__", as "select" (lazy loading, the
+        default), "selectin", "joined", "subquery", or "raise" to forbid lazy
+        loading:
+        >>> orm_defs = dict(
+        ...    User = dict(
+        ...      __tablename__ = 'users',
+        ...      __loading__ = dict(addresses = "selectin"),
+        ...      addresses = relationship("Address"),
+        ...    ),
+        ... )
+
+        This is the same as relationship("Address", lazy="selectin"), but keeps
+        strategies apart from relationships, which may then be shared by
+        orm_defs loading them differently. The relationships in orm_defs are
+        copied, not changed.
+
+        orm_defs may also be a function returning the ORM definitions, which a
+        pickled ORM calls again when rebuilt (see ORM(...)).
+
+        If the ORM was made with lazy_classes=True, classes are instead built
+        and mapped the first time they are used.
         '''
-        for name, dct in orm_defs.iteritems(): self.__mapped_class(name, self.Base, dct)
+        self._orm_defs.append(orm_defs)
+        if callable(orm_defs): orm_defs = orm_defs()
+        if self.lazy_classes:
+          for name, dct in orm_defs.items():
+            self._class_defs[name] = dct
+            self._class_tables[dct["__tablename__"]] = name
+            self._lazy_names.add(name)
+          return
+        for name, dct in orm_defs.items(): self.__mapped_class(name, self.Base, dct)
 
     def configure_with_engine(self, engine):
         '''
@@ -31,27 +268,150 @@ class ORM(object):
         '''
         # Configuration of subsequent database connections.
         self.engine = engine
+        if engine.dialect.name == "sqlite" and engine.dialect.driver in ("pysqlite", "aiosqlite"):
+          if not event.contains(engine, "savepoint", _begin_before_sqlite_savepoint):
+            event.listen(engine, "savepoint", _begin_before_sqlite_savepoint)
+        # Processes forked from this one mustn't share its connections or
+        # sessions.
+        _guard_pool(engine)
+        self._pid = os.getpid()
         # Reflect info from the new database connection.
         if self.def_refl:
+          # If the reflection cache is current, copy table info from cached
+          # metadata instead of reflecting it.
+          fingerprint, cached, preloaded = None, None, None
+          if self.reflection_cache is not None:
+            fingerprint = schema_fingerprint(self.engine)
+            cached = load_reflection_cache(self.reflection_cache, fingerprint)
+          if cached is not None:
+            preloaded, self._table_signatures = cached["metadata"], cached["signatures"]
+          else:
+            # Remember table schemas, so refresh_schema() can tell what changed.
+            self._table_signatures = table_signatures(self.engine)
+            if self.reflection_threads:
+              # Reflect tables in parallel, then copy table info from them.
+              if self.lazy_reflection: names = set(self.mapped_classes)
+              else: names = inspect(self.engine).get_table_names()
+              preloaded = reflect_parallel(self.engine, names, self.reflection_threads)
+          self.Base._preloaded_metadata = preloaded
+          if self.lazy_reflection:
+            self.Base.metadata.reflect_lazily(self.engine, preloaded)
           self.Base.prepare(self.engine)
           # In the next step we load, but don't map, any tables that haven't
-          # yet been loaded.
-          self.Base.metadata.reflect(self.engine)
+          # yet been loaded. Lazy reflection instead loads them on lookup.
+          if not self.lazy_reflection:
+            if preloaded is not None:
+              for table in preloaded.tables.values():
+                if table.key not in self.Base.metadata.tables: copy_table(table, self.Base.metadata)
+            else:
+              self.Base.metadata.reflect(self.engine)
+          if cached is None and self.reflection_cache is not None:
+            save_reflection_cache(self.reflection_cache, fingerprint, self.Base.metadata, self._table_signatures)
         else:
           self.Base.metadata.create_all(self.engine)
         # New sesison factory, this time bound to the new engine. Now any
         # sessions we make will also be bound to the engine.
-        self.session_factory = sessionmaker(self.engine)
+        if self.replicas:
+          # Reads go to replicas, writes to the engine.
+          replicas = [create_engine(replica, **self.engine_options) if isinstance(replica, string_types) else replica for replica in self.replicas]
+          for replica in replicas: _guard_pool(replica)
+          self.router = ReplicaRouter(replicas, self.replica_selection, self.read_your_writes)
+          self.session_factory = sessionmaker(self.engine, class_=RoutingSession, router=self.router)
+        else:
+          self.router = None
+          self.session_factory = sessionmaker(self.engine)
+        if self.session_scope is not None:
+          # Scoped sessions, one per thread or per scope.
+          if self.session_scope == "thread": scopefunc = None
+          else: scopefunc = self.session_scope
+          self.session_registry = scoped_session(self.session_factory, scopefunc=scopefunc)
+        if self.key_cache is not None:
+          # Cached keys of objects created in rolled back transactions, or of
+          # deleted objects, are stale.
+          event.listen(self.session_factory, "after_soft_rollback", lambda session, transaction: self.key_cache.clear())
+          event.listen(self.session_factory, "persistent_to_deleted", lambda session, obj: self.key_cache.invalidate_object(obj))
+        if self.query_stats is not None:
+          self.query_stats.attach(self.engine, self.session_factory, self.Base)
+          if self.router is not None:
+            for replica in self.router.replicas: self.query_stats.attach_engine(replica)
+
+    def refresh_schema(self):
+        '''
+        Reloads database table info for tables added, dropped, or altered
+        since table info was last loaded, leaving other tables alone. Returns
+        the names of these tables as a dict of sorted lists, with keys "added",
+        "dropped", and "altered".
+
+        Use:
+        >>> changes = orm.refresh_schema()
+
+        On SQLite and PostgreSQL, changes are found with a single catalog
+        query. On other databases, each loaded table is inspected.
+
+        New columns of mapped tables are mapped to new attributes of their
+        classes. Mapped tables that are dropped, or that lose columns, stay
+        mapped, since their classes may still be in use.
+        '''
+        metadata = self.Base.metadata
+        lazy = self.lazy_reflection
+        loaded = (lambda key: metadata.loaded(key)) if lazy else (lambda key: key in metadata.tables)
+        signatures = table_signatures(self.engine)
+        if signatures is not None and self._table_signatures is not None:
+          old, new = self._table_signatures, signatures
+          added = set(new) - set(old)
+          dropped = set(old) - set(new)
+          altered = set(key for key in set(old) & set(new) if old[key] != new[key])
+        else:
+          # Compare loaded tables to the database's current tables.
+          inspector = inspect(self.engine)
+          names = set(inspector.get_table_names())
+          known = set(key for key in dict(metadata.tables) if metadata.tables[key].schema is None)
+          if lazy: known |= metadata.known_names()
+          added = names - known
+          dropped = known - names
+          altered = set()
+          for key in known & names:
+            columns = [(column["name"], repr(column["type"]), column["nullable"]) for column in inspector.get_columns(key)]
+            if columns != [(column.name, repr(column.type), column.nullable) for column in metadata.tables[key].columns]:
+              altered.add(key)
+        self._table_signatures = signatures
+        # Cached table info for changed tables is stale.
+        self.Base._preloaded_metadata = None
+        if lazy: metadata.reflect_lazily(self.engine)
+        for key in dropped | altered:
+          if key in self.mapped_classes or not loaded(key): continue
+          metadata.remove(metadata.tables[key])
+        for key in added | altered:
+          if key in self.mapped_classes:
+            table = Table(key, metadata, autoload_with=self.engine, extend_existing=True, autoload_replace=False)
+            mapped_class = self.mapped_classes[key]
+            mapper = class_mapper(mapped_class)
+            for column in table.columns:
+              if not any(column is mapped for mapped in mapper.columns): mapper.add_property(column.key, column)
+            # Row types and lookup queries cached for the class are stale.
+            self._row_types.pop(mapped_class, None)
+            for shape in [shape for shape in self._lookup_queries if shape[0] is mapped_class]: del self._lookup_queries[shape]
+          elif not lazy:
+            Table(key, metadata, autoload_with=self.engine)
+        if self.reflection_cache is not None:
+          save_reflection_cache(self.reflection_cache, schema_fingerprint(self.engine), metadata, signatures)
+        return dict(added=sorted(added), dropped=sorted(dropped), altered=sorted(altered))
 
-    def create_engine(self, url):
+    def create_engine(self, url, **engine_options):
         '''
         Configures engine for database given by SQLAlchemy url, then loads
         database table info into ORM.
+
+        Engine options, such as pool_size, max_overflow, pool_recycle, and
+        pool_pre_ping, are passed to sqlalchemy.create_engine(...), and
+        override those given to ORM(...).
         '''
+        options = dict(self.engine_options)
+        options.update(engine_options)
         # Configuration of subsequent database connections.
-        self.configure_with_engine(create_engine(url))
+        self.configure_with_engine(create_engine(url, **options))
 
-    def __init__(self, orm_defs = None, engine = None, deferred_reflection = True):
+    def __init__(self, orm_defs = None, engine = None, deferred_reflection = True, reflection_cache = None, lazy_reflection = False, reflection_threads = None, session_scope = None, engine_options = None, key_cache_size = None, key_cache_ttl = None, instrument = False, slow_query_threshold = None, replicas = None, replica_selection = "round_robin", read_your_writes = None, lazy_classes = False):
         '''
         Creates and maps the ORM classes specified in orm_defs.  If SQLAlchemy
         database url/engine is given, loads database table info into ORM.
@@ -103,20 +463,125 @@ class ORM(object):
         - http://docs.sqlalchemy.org/en/rel_0_8/core/reflection.html
         - http://docs.sqlalchemy.org/en/rel_0_8/extensions/declarative.html
         or see test_orm() defined in this module.
+
+        If reflection_cache names a file, reflected table info is cached there,
+        and later ORMs given the same file load table info from it instead of
+        reflecting it, for as long as the database schema is unchanged. This
+        works with SQLite database files and PostgreSQL databases, and is
+        ignored for other databases.
+
+        If lazy_reflection is True, only the mapped tables, the tables they
+        refer to by foreign key, and association tables named by their
+        relationships are reflected up front. Other tables are reflected the
+        first time they are looked up in orm.Base.metadata.tables, or by
+        relationships.
+
+        If reflection_threads is a number, tables are reflected by that many
+        threads in parallel, each using its own pooled connection, which speeds
+        up reflection of databases with many tables over high-latency
+        connections. The engine's pool should allow as many connections.
+
+        By default orm.session is a single session shared by all users of the
+        ORM. If session_scope is "thread", orm.session is instead a separate
+        session per thread. If session_scope is a function, such as one
+        returning the current web request, orm.session is a separate session
+        per distinct value it returns. Either way, call orm.remove_session()
+        when done with a session, such as at the end of a request.
+
+        If engine is a url, engine_options, such as dict(pool_size=20,
+        pool_pre_ping=True), are passed to sqlalchemy.create_engine(...).
+
+        If key_cache_size is a number, get_or_create(...) caches the primary
+        keys of up to that many objects, by the keyword arguments that found
+        them, so repeat lookups are answered from the session's identity map,
+        or by primary key. If key_cache_ttl is a number, cached keys expire
+        after that many seconds. Cached keys are dropped when their objects are
+        deleted through the ORM, or when a session rolls back. See
+        orm.key_cache.stats() for hit and miss counts.
+
+        If instrument is True, statements executed, objects loaded, flushes,
+        and lazy relationship loads are counted; see orm.stats(). If
+        slow_query_threshold is a number, statements taking at least that many
+        seconds are also logged. Otherwise no listeners are attached, and
+        nothing is counted.
+
+        If replicas is a list of read replicas of the database, as SQLAlchemy
+        urls or engines, sessions read from them and write to the database
+        given by engine. Each transaction reads from one replica, chosen in
+        turn, or if replica_selection is "least_busy", by fewest connections
+        in use. Flushes, statements other than SELECTs, and all statements
+        after the first write of a transaction go to the primary database. If
+        read_your_writes is a number, sessions also read from the primary for
+        that many seconds after committing writes, so they see their own
+        writes despite replication lag.
+
+        ORMs are safe to use in forked processes: a process that finds it
+        didn't configure its ORM discards inherited sessions first, and its
+        engines' pools don't hand out connections made by other processes.
+        ORMs can also be pickled, for use in spawned processes, as
+        their orm_defs, including those later given to
+        create_mapped_classes(...), database url, and options, and are rebuilt
+        from them, loading table info from reflection_cache if given. orm_defs
+        should then be a picklable function returning the ORM definitions,
+        such as a module-level function, since classes, columns, and
+        relationships created for mapping can't be pickled.
+
+        If lazy_classes is True, each class in orm_defs is built, and mapped
+        if there is an engine, the first time it is used, as orm.ThingClass1
+        or as orm.mapped_classes['thing_1_table'], along with the classes its
+        relationships refer to by name. Processes using few of many classes
+        then spend little time and memory on the rest. Combine with
+        lazy_reflection=True to also reflect only the tables of classes used.
+        Backrefs only appear once the classes defining them are built.
         '''
-        self.mapped_classes = dict()
+        # Arguments to rebuild this ORM from, when pickled, besides each
+        # orm_defs given, recorded by create_mapped_classes(...).
+        self._orm_defs = list()
+        self._init_args = dict(
+          deferred_reflection = deferred_reflection, reflection_cache = reflection_cache,
+          lazy_reflection = lazy_reflection, reflection_threads = reflection_threads,
+          session_scope = session_scope, engine_options = engine_options,
+          key_cache_size = key_cache_size, key_cache_ttl = key_cache_ttl,
+          instrument = instrument, slow_query_threshold = slow_query_threshold,
+          replicas = replicas, replica_selection = replica_selection, read_your_writes = read_your_writes,
+          lazy_classes = lazy_classes,
+        )
+        # Lazily defined classes not yet built, by name; names of all lazily
+        # defined classes, by table name and as a set; and a lock for building
+        # them.
+        self.lazy_classes = lazy_classes
+        self._class_defs = dict()
+        self._class_tables = dict()
+        self._lazy_names = set()
+        self._class_lock = threading.RLock()
+        self.mapped_classes = LazyMappedClasses(self) if lazy_classes else dict()
         # Prep SQLAlchemy reflection with new SQLAlchemy declarative Base,
         # discarding any existing Base, engine, and session factory. Reflection
         # may be deferred if engine isn't specified.
         self.def_refl = deferred_reflection
-        self.Base = declarative_base(cls=DeferredReflection if self.def_refl else object)
+        self.reflection_cache = reflection_cache
+        self._table_signatures = None
+        self.lazy_reflection = lazy_reflection and self.def_refl
+        self.reflection_threads = reflection_threads
+        self.session_scope = session_scope
+        self._lookup_queries = dict()
+        self._row_types = dict()
+        self.key_cache = KeyCache(key_cache_size, key_cache_ttl) if key_cache_size else None
+        self.replicas = replicas
+        self.replica_selection = replica_selection
+        self.read_your_writes = read_your_writes
+        self.query_stats = QueryStats(self.mapped_classes, slow_query_threshold) if instrument else None
+        self.engine_options = engine_options or dict()
+        self.Base = declarative_base(
+          cls=PreloadedReflection if self.def_refl else object,
+          metadata=LazyMetaData() if self.lazy_reflection else None,
+        )
         # Create mapped classes if given.
-        if orm_defs is None: orm_defs = dict() # Empty dict.
-        self.create_mapped_classes(orm_defs)
+        if orm_defs is not None: self.create_mapped_classes(orm_defs)
         # Create or configure engine if given.
         if engine is not None:
           # "engine" can be either an SQLAlchemy url, or an SQLAlchemy engine.
-          if type(engine) in (str, unicode): self.create_engine(engine)
+          if isinstance(engine, string_types): self.create_engine(engine)
           else: self.configure_with_engine(engine)
         # Convenience monkeypatch for displaying ORM objects.
         def monkey_repr(self):
@@ -125,16 +590,158 @@ class ORM(object):
             return "<{name}: {attr_dict}>".format(name=self.__class__.__name__, attr_dict=attr_dict)
         self.Base.__repr__ = monkey_repr
 
+    def __reduce__(self):
+        '''
+        Pickles this ORM as its orm_defs, database url, and options, from which
+        it is rebuilt. Connections, sessions, and objects aren't pickled.
+        '''
+        orm_defs, options = list(self._orm_defs), self._init_args
+        url = self.engine.url.render_as_string(hide_password=False) if hasattr(self, "engine") else None
+        options = dict(options)
+        if options["replicas"]:
+          options["replicas"] = [replica if isinstance(replica, string_types) else replica.url.render_as_string(hide_password=False) for replica in options["replicas"]]
+        return (_rebuild_orm, (type(self), orm_defs, url, options))
+
+    def _check_fork(self):
+        '''
+        Internal function discarding connections and sessions inherited from a
+        parent process, which mustn't be used by both processes.
+        '''
+        if getattr(self, "_pid", None) in (None, os.getpid()): return
+        self._pid = os.getpid()
+        engines = [self.engine] + (self.router.replicas if self.router is not None else [])
+        # Leave the parent's connections open for the parent. Asyncio engines
+        # are disposed of through their synchronous engines, without awaiting.
+        for engine in engines: getattr(engine, "sync_engine", engine).dispose(close=False)
+        self.__dict__.pop("_session", None)
+        if self.session_scope is not None: self.session_registry.registry.clear()
+
     def create_session(self):
         '''Creates and returns an SQLAlchemy database session for this ORM.'''
+        self._check_fork()
         return self.session_factory()
 
     @property
     def session(self):
-        '''Convenient access to per-ORM session.'''
+        '''Convenient access to per-ORM session, or per-scope session if session_scope was given.'''
+        self._check_fork()
+        if self.session_scope is not None: return self.session_registry()
         if not hasattr(self, "_session"): self._session = self.create_session()
         return self._session
 
+    def remove_session(self):
+        '''
+        Closes the current orm.session, discarding its objects and returning
+        its connections to the pool. Next use of orm.session gets a new one.
+        '''
+        self._check_fork()
+        if self.session_scope is not None:
+          self.session_registry.remove()
+        elif hasattr(self, "_session"):
+          self._session.close()
+          del self._session
+
+    def stats(self):
+        '''
+        Returns statistics of what this ORM did to its database, as a dict,
+        or None if the ORM wasn't made with instrument=True.
+
+        Use:
+        >>> orm = ORM(orm_defs, url, instrument=True, slow_query_threshold=0.5)
+        >>> stats = orm.stats()
+        >>> stats["queries"]["count"], stats["n_plus_one"]
+
+        "queries" has the count, total seconds, and latency histogram of all
+        statements, and "statements" and "classes" have the same per statement
+        and per mapped class. Histograms map upper bounds in seconds to counts,
+        with None bounding slower statements. "rows" counts objects loaded per
+        mapped class, "flushes" counts flushes and the objects they wrote, and
+        "slow_queries" lists recent slow statements. "lazy_loads" has the most
+        times each relationship was lazily loaded in one session, and
+        "n_plus_one" describes those loaded often enough to suggest N+1 query
+        patterns, such as "User.addresses lazily loaded 500 times in one
+        session".
+        '''
+        if self.query_stats is None: return None
+        return self.query_stats.snapshot()
+
+    def reset_stats(self):
+        '''Discards statistics collected so far. See stats().'''
+        if self.query_stats is not None: self.query_stats.reset()
+
+    def _lookup_query(self, mapped_class, keyword_args):
+        '''
+        Internal convenience function to query for objects using keyword arguments.
+
+        Queries are cached per mapped class, keyword set, and keywords whose
+        arguments are None, with arguments passed as bound parameters, so
+        repeated lookups of the same shape skip building the query.
+        '''
+        columns = class_mapper(mapped_class).columns
+        if not all(keyword in columns for keyword in keyword_args):
+          # Lookups by relationship, or by nonsense attributes, aren't cached.
+          q = self.session.query(mapped_class)
+          for keyword, argument in keyword_args.items():
+            q = q.filter(getattr(mapped_class, keyword)==argument)
+          return q
+        shape = (mapped_class, tuple(sorted((keyword, argument is None) for keyword, argument in keyword_args.items())))
+        q = self._lookup_queries.get(shape)
+        if q is None:
+          q = Query(mapped_class)
+          for keyword, is_none in shape[1]:
+            column = getattr(mapped_class, keyword)
+            q = q.filter(column.is_(None) if is_none else column==bindparam(keyword))
+          self._lookup_queries[shape] = q
+        q = q.with_session(self.session)
+        params = dict((keyword, argument) for keyword, argument in keyword_args.items() if argument is not None)
+        return q.params(**params) if params else q
+
+    def _lookup_unique(self, mapped_class, q):
+        '''
+        Internal convenience function returning the object found by query q, or
+        None if there is no such object. Fetches at most two rows, which is
+        enough to fail by raising MultipleResultsFound if the object isn't
+        unique.
+        '''
+        found = q.limit(2).all()
+        if len(found) > 1:
+          raise MultipleResultsFound("Multiple '{}' objects were found when one was required.".format(mapped_class.__name__))
+        return found[0] if found else None
+
+    def _get_or_create(self, mapped_class, keyword_args, create_args):
+        '''
+        Internal implementation of get_or_create(...), creating missing objects
+        using create_args.
+        '''
+        cache, natural_key = self.key_cache, None
+        if cache is not None:
+          natural_key = cache.natural_key(mapped_class, keyword_args)
+          identity = cache.get(natural_key) if natural_key is not None else None
+          if identity is not None:
+            cached_object = self.session.get(mapped_class, identity)
+            # The object may have been deleted, or its attributes changed, since.
+            if cached_object is not None and all(getattr(cached_object, keyword) == argument for keyword, argument in keyword_args.items()):
+              return cached_object
+            cache.invalidate(natural_key)
+        q = self._lookup_query(mapped_class, keyword_args)
+        unique_object = self._lookup_unique(mapped_class, q)
+        if unique_object is not None:
+          if cache is not None: cache.put(natural_key, unique_object)
+          return unique_object
+        unique_object = mapped_class(**create_args)
+        try:
+          # Insert within a SAVEPOINT, so a conflicting insert by a concurrent
+          # writer only rolls back this insert.
+          with self.session.begin_nested():
+            self.session.add(unique_object)
+        except IntegrityError:
+          # If a concurrent writer created the object first, use it instead.
+          existing_object = self._lookup_unique(mapped_class, q)
+          if existing_object is None: raise
+          return existing_object
+        if cache is not None: cache.put(natural_key, unique_object)
+        return unique_object
+
     def get_or_create(self, mapped_class, **keyword_args):
         '''
         Get or create a unique object from the database.
@@ -147,37 +754,501 @@ class ORM(object):
         the database, and returned.  Fails if name is common to more than one
         Thing in the database.
 
+        Found objects are fetched with a single query. Created objects are
+        flushed within a SAVEPOINT; if a concurrent writer has meanwhile
+        created the object, violating a unique constraint, the insert is
+        rolled back and the concurrent writer's object is returned.
+
         No exception handling here! Do it at a higher level.
         '''
-        q = self.session.query(mapped_class)
-        for keyword, argument in keyword_args.iteritems():
+        return self._get_or_create(mapped_class, keyword_args, keyword_args)
+
+    def stream(self, mapped_class, batch_size = 1000, **keyword_args):
+        '''
+        Iterates over all objects of mapped_class with attributes given by
+        keyword arguments, in lists of up to batch_size objects, keeping only
+        one list in memory at a time.
+
+        Use:
+        >>> for things in orm.stream(orm.Thing, batch_size=1000, color="Blue"):
+        ...   for thing in things: process(thing)
+
+        Objects are loaded by their own session, which expunges each list once
+        the next is requested, so objects are detached by then, and must not
+        lazily load unloaded attributes. Changes pending in orm.session aren't
+        seen.
+
+        Rows are streamed from a server-side cursor on databases that support
+        them, such as PostgreSQL. On other databases, such as SQLite, objects
+        are fetched by keyset pagination on the primary key, one query per
+        list. Objects with composite primary keys are fetched by a single query
+        instead.
+        '''
+        session = self.create_session()
+        try:
+          q = session.query(mapped_class)
+          for keyword, argument in keyword_args.items():
+            q = q.filter(getattr(mapped_class, keyword)==argument)
+          mapper = class_mapper(mapped_class)
+          if self.engine.dialect.supports_server_side_cursors or len(mapper.primary_key) != 1:
+            batch = list()
+            for obj in q.yield_per(batch_size).execution_options(stream_results=True):
+              batch.append(obj)
+              if len(batch) == batch_size:
+                yield batch
+                for obj in batch: session.expunge(obj)
+                batch = list()
+            if batch: yield batch
+          else:
+            column = mapper.primary_key[0]
+            key = mapper.get_property_by_column(column).key
+            q = q.order_by(column)
+            batch = q.limit(batch_size).all()
+            while batch:
+              last = getattr(batch[-1], key)
+              yield batch
+              for obj in batch: session.expunge(obj)
+              if len(batch) < batch_size: break
+              batch = q.filter(column > last).limit(batch_size).all()
+        finally:
+          session.close()
+
+    def map_partitions(self, mapped_class, function, partitions = None, processes = None, **keyword_args):
+        '''
+        Partitions objects of mapped_class with attributes given by keyword
+        arguments into ranges of their integer primary key, calls
+        function(orm, objects) for each partition in a pool of worker
+        processes, and returns the results in primary key order.
+
+        Use:
+        >>> def summarize(orm, things): return sum(len(thing.name) for thing in things)
+        >>> total = sum(orm.map_partitions(orm.Thing, summarize, processes=8, color="Blue"))
+
+        Workers get pickled copies of this ORM, so it must be picklable (see
+        ORM(...)), as must function, such as a module-level function. The
+        database must be reachable from other processes, which in-memory
+        SQLite databases aren't. Each partition's objects are loaded by the
+        worker's orm.session, which is committed after function returns, so
+        function may change them.
+
+        processes defaults to the number of CPUs, and partitions to four per
+        process. Fails with ValueError if mapped_class doesn't have a
+        single-column primary key.
+        '''
+        # concurrent.futures is standard as of Python 3.2.
+        from concurrent.futures import ProcessPoolExecutor
+        mapper = class_mapper(mapped_class)
+        if len(mapper.primary_key) != 1:
+          raise ValueError("Cannot partition '{}' ORM objects: they don't have a single-column primary key.".format(mapped_class.__name__))
+        column = mapper.primary_key[0]
+        q = self.session.query(func.min(column), func.max(column))
+        for keyword, argument in keyword_args.items():
           q = q.filter(getattr(mapped_class, keyword)==argument)
-        if q.count():
-          # If the object is not uniquely specified by the keyword arguments,
-          # this should fail by raising an exception.
-          return q.one()
-        else:
-          unique_object = mapped_class(**keyword_args)
-          self.session.add(unique_object)
-          return unique_object
+        low, high = q.one()
+        if low is None: return list()
+        processes = processes or multiprocessing.cpu_count()
+        partitions = partitions or 4 * processes
+        # Ceiling division, so there are at most partitions partitions.
+        step = max(1, -(-(high - low + 1) // partitions))
+        key = mapper.get_property_by_column(column).key
+        tasks = [(mapped_class.__name__, key, start, start + step, keyword_args, function) for start in range(low, high + 1, step)]
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(self,)) as executor:
+          return list(executor.map(_map_partition, tasks))
+
+    def read_rows(self, mapped_class, **keyword_args):
+        '''
+        Returns a list of read-only rows of the table of mapped_class, with
+        attributes given by keyword arguments, as with get_or_create(...).
+
+        Use:
+        >>> for thing in orm.read_rows(orm.Thing, color="Blue"):
+        ...   print(thing.name)
+
+        Rows are named tuples, with a field per column attribute of
+        mapped_class, selected with a Core statement, so they aren't tracked
+        by orm.session, and are much lighter to build and keep than objects.
+        Use them for reports; changes to them aren't saved. Fails with
+        AttributeError if keyword arguments name nonexistent column attributes.
+        '''
+        mapper = class_mapper(mapped_class)
+        if mapped_class not in self._row_types:
+          keys = [prop.key for prop in mapper.column_attrs]
+          self._row_types[mapped_class] = (keys, namedtuple(mapped_class.__name__ + "Row", keys, rename=True))
+        keys, row_type = self._row_types[mapped_class]
+        statement = select(*[mapper.columns[key] for key in keys])
+        for keyword, argument in keyword_args.items():
+          if keyword not in mapper.columns:
+            raise AttributeError("Cannot read rows: '{}' ORM objects have no column attribute '{}'.".format(mapped_class.__name__, keyword))
+          statement = statement.where(mapper.columns[keyword]==argument)
+        return [row_type._make(row) for row in self.session.execute(statement)]
+
+    def bulk_load(self, mapped_class, rows, chunk_size = 1000, commit_every = None, progress = None):
+        '''
+        Inserts rows, an iterable of dicts keyed by column name, into the table
+        of mapped_class, without creating objects. Returns a dict of "rows"
+        inserted, "seconds" taken, and "rows_per_second".
+
+        Use:
+        >>> stats = orm.bulk_load(orm.Thing, ({"name": name} for name in names), chunk_size=5000, commit_every=100000)
+
+        Rows are inserted chunk_size at a time, by one executemany() call per
+        chunk, or per run of consecutive rows with the same keys if rows of a
+        chunk have different keys, within orm.session's transaction. If commit_every is given,
+        orm.session is committed after every chunk ending at least commit_every
+        rows after the last commit, and at the end; otherwise committing is up
+        to the caller. If progress is given, it's called with the stats so far
+        after every chunk.
+
+        Fails with AttributeError if a row has keys that aren't column names,
+        before any of its chunk is inserted.
+        '''
+        table = class_mapper(mapped_class).local_table
+        column_names = set(table.columns.keys())
+        insert = table.insert()
+        # Flush first, so pending objects are inserted before the rows.
+        self.session.flush()
+        stats = dict(rows=0, seconds=0., rows_per_second=0.)
+        start = time.time()
+        uncommitted = 0
+        rows = iter(rows)
+        while True:
+          chunk = list(islice(rows, chunk_size))
+          if not chunk: break
+          unknown = set().union(*chunk) - column_names
+          if unknown:
+            raise AttributeError("Cannot load rows: '{}' table has no columns {}.".format(table.name, sorted(unknown)))
+          # executemany() inserts only the columns of the first row given.
+          for _, same_keys in groupby(chunk, key = frozenset):
+            self.session.execute(insert, list(same_keys))
+          uncommitted += len(chunk)
+          if commit_every is not None and uncommitted >= commit_every:
+            self.session.commit()
+            uncommitted = 0
+          stats["rows"] += len(chunk)
+          stats["seconds"] = time.time() - start
+          stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.
+          if progress is not None: progress(dict(stats))
+        if commit_every is not None and uncommitted: self.session.commit()
+        stats["seconds"] = time.time() - start
+        stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.
+        return stats
+
+    def bulk_load_csv(self, mapped_class, path, null = "", **keyword_args):
+        '''
+        Inserts rows from the CSV file at path, whose header names columns,
+        into the table of mapped_class, using bulk_load(...), which is passed
+        any keyword arguments. Fields equal to null, by default empty fields,
+        are loaded as NULL. Returns bulk_load(...)'s stats.
+
+        Use:
+        >>> stats = orm.bulk_load_csv(orm.Thing, "things.csv", chunk_size=5000)
+        '''
+        if sys.version_info[0] < 3: csv_file = open(path, "rb")
+        else: csv_file = open(path, newline="")
+        with csv_file:
+          rows = (
+            dict((key, None if value == null else value) for key, value in row.items())
+            for row in csv.DictReader(csv_file)
+          )
+          return self.bulk_load(mapped_class, rows, **keyword_args)
+
+    def get_or_create_many(self, mapped_class, key_dicts, chunk_size = 500):
+        '''
+        Get or create many unique objects from the database at once.
+
+        Use:
+        >>> x, y = orm.get_or_create_many(orm.Thing, [dict(name="Rumplestiltskin"), dict(name="Rapunzel")])
+
+        Equivalent to calling get_or_create(mapped_class, **key_dict) for each
+        dict in key_dicts, and returns the objects in the same order, but looks
+        up existing objects using one "IN" query per chunk_size distinct keys,
+        and flushes all missing objects in one batch within a SAVEPOINT. Duplicate
+        key dicts yield the same object. Fails if a key dict is common to more
+        than one object in the database, or names a nonexistent attribute.
+
+        Key values should have the Python types of their columns, since found
+        objects are matched to key dicts by comparing attribute values. Key
+        dicts with None values, or naming attributes other than columns, such
+        as relationships, are looked up one at a time by get_or_create(...).
+        '''
+        key_dicts = list(key_dicts)
+        mapped_columns = class_mapper(mapped_class).columns
+        unique_objects = [None] * len(key_dicts)
+        # Group key dicts by keywords, so each group can be looked up with
+        # queries of the same shape.
+        groups = dict()
+        for position, key_dict in enumerate(key_dicts):
+          if not key_dict or None in key_dict.values() or not all(keyword in mapped_columns for keyword in key_dict):
+            # "IN" can't match NULL, or objects of relationships, so do these
+            # the slow way.
+            unique_objects[position] = self.get_or_create(mapped_class, **key_dict)
+          else:
+            groups.setdefault(tuple(sorted(key_dict)), list()).append(position)
+        for keywords, positions in groups.items():
+          columns = [getattr(mapped_class, keyword) for keyword in keywords]
+          keys, seen = list(), set()
+          for position in positions:
+            key = tuple(key_dicts[position][keyword] for keyword in keywords)
+            if key not in seen:
+              seen.add(key)
+              keys.append(key)
+          # Look up existing objects, chunk_size keys at a time.
+          found = dict()
+          for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            if len(columns) == 1:
+              criterion = columns[0].in_([key[0] for key in chunk])
+            else:
+              criterion = tuple_(*columns).in_(chunk)
+            for obj in self.session.query(mapped_class).filter(criterion):
+              key = tuple(getattr(obj, keyword) for keyword in keywords)
+              if key in found:
+                raise MultipleResultsFound("Multiple '{}' objects were found for {}.".format(mapped_class.__name__, dict(zip(keywords, key))))
+              found[key] = obj
+          # Create the missing objects in one batch.
+          created = list()
+          for key in keys:
+            if key not in found:
+              found[key] = mapped_class(**dict(zip(keywords, key)))
+              created.append(found[key])
+          try:
+            with self.session.begin_nested():
+              self.session.add_all(created)
+          except IntegrityError:
+            # Concurrent writers created some of these objects first, so
+            # resolve the created objects one at a time.
+            for obj in created:
+              key = tuple(getattr(obj, keyword) for keyword in keywords)
+              found[key] = self.get_or_create(mapped_class, **dict(zip(keywords, key)))
+          for position in positions:
+            unique_objects[position] = found[tuple(key_dicts[position][keyword] for keyword in keywords)]
+        return unique_objects
+
+    def prefetch(self, objects, *paths):
+        '''
+        Loads relationships named by dotted paths for objects in orm.session,
+        and returns the objects.
+
+        Use:
+        >>> users = orm.session.query(orm.User).all()
+        >>> orm.prefetch(users, "addresses", "addresses.user")
+
+        Objects are selected again by primary key, 500 at a time, along with
+        each hop of each path using "SELECT ... IN" loading, so touching the
+        relationships afterward doesn't query each object's relationships one
+        by one. Relationships already loaded are left alone. Fails with
+        AttributeError if a path names a nonexistent relationship.
+        '''
+        objects = list(objects)
+        groups = dict()
+        for obj in objects:
+          identity = inspect(obj).identity
+          if identity is not None: groups.setdefault(type(obj), set()).add(identity)
+        for mapped_class, identities in groups.items():
+          mapper = class_mapper(mapped_class)
+          options = list()
+          for path in paths:
+            option, hop_mapper = None, mapper
+            for key in path.split("."):
+              if key not in hop_mapper.relationships:
+                raise AttributeError("Cannot prefetch '{}': '{}' ORM objects have no relationship '{}'.".format(path, hop_mapper.class_.__name__, key))
+              attribute = getattr(hop_mapper.class_, key)
+              option = selectinload(attribute) if option is None else option.selectinload(attribute)
+              hop_mapper = hop_mapper.relationships[key].mapper
+            options.append(option)
+          columns = list(mapper.primary_key)
+          identities = list(identities)
+          for start in range(0, len(identities), 500):
+            chunk = identities[start:start + 500]
+            if len(columns) == 1:
+              criterion = columns[0].in_([identity[0] for identity in chunk])
+            else:
+              criterion = tuple_(*columns).in_(chunk)
+            self.session.query(mapped_class).filter(criterion).options(*options).all()
+        return objects
+
+    def _check_attributes(self, obj, keywords):
+        '''
+        Internal convenience function to verify that an object or mapped class
+        has attributes named by keywords.
+        '''
+        for key in keywords:
+          if not hasattr(obj, key):
+            name = obj.__name__ if isinstance(obj, type) else obj.__class__.__name__
+            raise AttributeError("Cannot update object: '{}' ORM objects have no attribute '{}'.".format(name, key))
 
     def _update_object(self, obj, **keyword_args):
         '''
         Internal convenience function to update an object using keyword arguments.
         '''
-        for key in keyword_args:
-          if not hasattr(obj, key):
-            raise AttributeError("Cannot update object: '{}' ORM objects have no attribute '{}'.".format(obj.__class__.__name__, key))
-        for key, value in keyword_args.iteritems():
+        self._check_attributes(obj, keyword_args)
+        for key, value in keyword_args.items():
           setattr(obj, key, value)
 
-    def get_or_create_and_update(self, mapped_class, query_dict, update_dict):
+    def _upsert_statement(self, mapped_class, query_keys, update_keys):
+        '''
+        Internal convenience function returning a dialect-native "INSERT ... ON
+        CONFLICT DO UPDATE" statement for mapped_class, with conflicts detected
+        on the columns named by query_keys and resolved by updating the columns
+        named by update_keys. Returns None if the database has no upsert
+        support, or SQLAlchemy has none for the database.
+        '''
+        dialect = self.engine.dialect
+        try:
+          if dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+          elif dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info >= (3, 24):
+            from sqlalchemy.dialects.sqlite import insert
+          else:
+            return None
+        except ImportError:
+          return None
+        columns = class_mapper(mapped_class).columns
+        for key in list(query_keys) + list(update_keys):
+          if key not in columns:
+            raise AttributeError("Cannot update object: '{}' ORM objects have no column attribute '{}'.".format(mapped_class.__name__, key))
+        statement = insert(columns[query_keys[0]].table)
+        index_elements = [columns[key] for key in query_keys]
+        if not update_keys:
+          return statement.on_conflict_do_nothing(index_elements = index_elements)
+        return statement.on_conflict_do_update(
+          index_elements = index_elements,
+          set_ = dict((columns[key].name, statement.excluded[columns[key].name]) for key in update_keys),
+        )
+
+    def _upsert_params(self, mapped_class, query_dict, update_dict):
+        '''
+        Internal convenience function returning upsert statement parameters,
+        keyed by column name, for given query and update dicts.
+        '''
+        columns = class_mapper(mapped_class).columns
+        params = dict((columns[key].name, value) for key, value in query_dict.items())
+        params.update((columns[key].name, value) for key, value in update_dict.items())
+        return params
+
+    def _has_null(self, query_dict):
+        '''
+        Internal convenience function returning whether query_dict has None
+        values, which upserts can't match, since NULLs never conflict.
+        '''
+        return any(value is None for value in query_dict.values())
+
+    def get_or_create_and_update(self, mapped_class, query_dict, update_dict, upsert = False):
         '''
         Get or create unique object with attributes from query_dict, and update with attributes from update_dict.
 
         Use:
         >>> x = orm.get_or_create_and_update(orm.Thing, dict(name="Rumplestiltskin"), dict(attribute="Sneakiness"))
+
+        If upsert is True and the database supports it (SQLite and
+        PostgreSQL), the object is instead created or updated by a single
+        "INSERT ... ON CONFLICT DO UPDATE" statement, then loaded. This requires
+        a unique constraint on exactly the columns named in query_dict.
+        Otherwise upsert is ignored, as it is if query_dict has None values,
+        since NULLs never conflict.
+
+        Within "with orm.batch():", the call is buffered instead, and returns
+        None. See batch(...).
         '''
-        unique_object = self.get_or_create(mapped_class, **query_dict)
+        write_buffer = self.session.info.get("irrealis_orm.write_buffer")
+        if write_buffer is not None:
+          return write_buffer.add(mapped_class, query_dict, update_dict)
+        if upsert and query_dict and not self._has_null(query_dict):
+          statement = self._upsert_statement(mapped_class, sorted(query_dict), sorted(update_dict))
+          if statement is not None:
+            # Flush first, so the upsert sees pending objects.
+            self.session.flush()
+            self.session.execute(statement, self._upsert_params(mapped_class, query_dict, update_dict))
+            q = self._lookup_query(mapped_class, query_dict).populate_existing()
+            return self._lookup_unique(mapped_class, q)
+        # Created objects get the update right away, in case it sets columns
+        # the database requires.
+        self._check_attributes(mapped_class, update_dict)
+        create_dict = dict(query_dict)
+        create_dict.update(update_dict)
+        unique_object = self._get_or_create(mapped_class, query_dict, create_dict)
         self._update_object(unique_object, **update_dict)
         return unique_object
+
+    @contextmanager
+    def batch(self, size = 5000):
+        '''
+        Buffers get_or_create_and_update(...) calls made within the context,
+        and writes them in batches of size distinct objects, and when leaving
+        the context.
+
+        Use:
+        >>> with orm.batch(size=5000):
+        ...   for name, attribute in rows:
+        ...     orm.get_or_create_and_update(orm.Thing, dict(name=name), dict(attribute=attribute))
+        >>> orm.session.commit()
+
+        Calls with the same mapped class and query dict update the same
+        buffered object, so only its final state is written. Each batch looks
+        up existing objects with one query per 500 objects of a class, then
+        inserts missing objects with one bulk insert, and updates existing
+        objects with one bulk update, instead of a query and a flush per call.
+        The database ends up as if the calls had been made outside the
+        context, but:
+        - buffered calls return None rather than objects;
+        - buffered writes aren't seen by queries until their batch is written;
+        - only column attributes may be given;
+        - failures, like MultipleResultsFound, are raised when the batch is
+          written.
+
+        If the context is left by an exception, calls not yet written are
+        discarded. Nested contexts share the outermost context's buffer. The
+        buffer belongs to orm.session, so with session_scope given, only calls
+        using the same session, such as those of the same thread, are
+        buffered.
+        '''
+        info = self.session.info
+        if info.get("irrealis_orm.write_buffer") is not None:
+          yield info["irrealis_orm.write_buffer"]
+          return
+        write_buffer = info["irrealis_orm.write_buffer"] = WriteBehindBuffer(self, size)
+        try:
+          yield write_buffer
+          write_buffer.flush()
+        finally:
+          write_buffer.discard()
+          info.pop("irrealis_orm.write_buffer", None)
+
+    def upsert_many(self, mapped_class, query_and_update_dicts):
+        '''
+        Get or create and update many unique objects at once.
+
+        Use:
+        >>> orm.upsert_many(orm.Thing, [
+        ...   (dict(name="Rumplestiltskin"), dict(attribute="Sneakiness")),
+        ...   (dict(name="Rapunzel"), dict(attribute="Hairiness")),
+        ... ])
+
+        Equivalent to calling get_or_create_and_update(mapped_class,
+        query_dict, update_dict, upsert = True) for each (query_dict,
+        update_dict) pair, but pairs sharing the same keys are upserted with a
+        single executemany() call, and objects aren't loaded or returned.
+        Objects of mapped_class already in the session are expired, so their
+        new attributes are loaded on next access.
+
+        Falls back to get_or_create_and_update(...) for each pair if the
+        database has no upsert support, and for pairs whose query_dict has None
+        values.
+        '''
+        groups = dict()
+        for query_dict, update_dict in query_and_update_dicts:
+          if self._has_null(query_dict):
+            self.get_or_create_and_update(mapped_class, query_dict, update_dict)
+            continue
+          shape = (tuple(sorted(query_dict)), tuple(sorted(update_dict)))
+          groups.setdefault(shape, list()).append((query_dict, update_dict))
+        for (query_keys, update_keys), pairs in groups.items():
+          statement = self._upsert_statement(mapped_class, query_keys, update_keys) if query_keys else None
+          if statement is None:
+            for query_dict, update_dict in pairs:
+              self.get_or_create_and_update(mapped_class, query_dict, update_dict)
+            continue
+          self.session.flush()
+          self.session.execute(statement, [self._upsert_params(mapped_class, query_dict, update_dict) for query_dict, update_dict in pairs])
+          for obj in list(self.session.identity_map.values()):
+            if isinstance(obj, mapped_class): self.session.expire(obj)
@@ -0,0 +1,163 @@
+'''
+Asyncio variant of the ORM, using SQLAlchemy's asyncio extension. Requires
+Python 3 and an asyncio database driver, such as aiosqlite or asyncpg.
+'''
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+from irrealis_orm import ORM
+
+def _synchronous_only(name):
+    '''
+    Internal function returning a method failing with TypeError, to replace
+    ORM's synchronous method of given name, which AsyncORM doesn't support.
+    '''
+    def method(self, *args, **keyword_args):
+        raise TypeError("AsyncORM doesn't support {}(...), which is synchronous; use an ORM for it.".format(name))
+    method.__name__ = name
+    method.__doc__ = "Not supported by AsyncORM, since ORM.{}(...) is synchronous.".format(name)
+    return method
+
+class AsyncORM(ORM):
+    '''
+    Sets up SQLAlchemy object relational mappings for use with asyncio.
+
+    Use as follows:
+    >>> orm = AsyncORM(orm_defs)
+    >>> await orm.create_engine("sqlite+aiosqlite:///database.db")
+
+    Or:
+    >>> engine = create_async_engine("sqlite+aiosqlite:///database.db")
+    >>> orm = AsyncORM(orm_defs)
+    >>> await orm.configure_with_engine(engine)
+
+    Then:
+    >>> thing = await orm.get_or_create(orm.Thing, name="Rumplestiltskin")
+    >>> await orm.session.commit()
+
+    orm.session is an AsyncSession. Relationships can't be loaded lazily with
+    asyncio, so load them eagerly, for example with selectinload(...).
+
+    ORM's synchronous helpers, such as stream(...), bulk_load(...), and
+    batch(...), aren't supported, and fail with TypeError.
+    '''
+    stream = _synchronous_only("stream")
+    map_partitions = _synchronous_only("map_partitions")
+    read_rows = _synchronous_only("read_rows")
+    bulk_load = _synchronous_only("bulk_load")
+    bulk_load_csv = _synchronous_only("bulk_load_csv")
+    get_or_create_many = _synchronous_only("get_or_create_many")
+    prefetch = _synchronous_only("prefetch")
+    batch = _synchronous_only("batch")
+    upsert_many = _synchronous_only("upsert_many")
+    refresh_schema = _synchronous_only("refresh_schema")
+
+    def __init__(self, orm_defs = None, deferred_reflection = True, reflection_cache = None, engine_options = None):
+        '''
+        Creates and maps the ORM classes specified in orm_defs. Unlike ORM(...),
+        doesn't take an engine, since configuring one must be awaited.
+        '''
+        ORM.__init__(self, orm_defs, deferred_reflection = deferred_reflection, reflection_cache = reflection_cache, engine_options = engine_options)
+
+    def __reduce__(self):
+        raise TypeError("AsyncORM instances can't be pickled, since configuring their engines must be awaited.")
+
+    async def configure_with_engine(self, engine):
+        '''
+        Loads database table info from asyncio engine into ORM.
+        '''
+        async with engine.connect() as connection:
+          # Reflection is synchronous, so run it in SQLAlchemy's greenlet
+          # context, where the engine's synchronous facade may be used.
+          await connection.run_sync(lambda sync_connection: ORM.configure_with_engine(self, sync_connection.engine))
+        self.engine = engine
+        # Sessions are AsyncSessions. Objects aren't expired upon commit,
+        # since expired attributes couldn't be loaded lazily.
+        self.session_factory = sessionmaker(self.engine, class_ = AsyncSession, expire_on_commit = False)
+
+    async def create_engine(self, url, **engine_options):
+        '''
+        Configures asyncio engine for database given by SQLAlchemy url, then
+        loads database table info into ORM.
+        '''
+        options = dict(self.engine_options)
+        options.update(engine_options)
+        await self.configure_with_engine(create_async_engine(url, **options))
+
+    async def remove_session(self):
+        '''
+        Closes the current orm.session, discarding its objects and returning
+        its connections to the pool. Next use of orm.session gets a new one.
+        '''
+        if hasattr(self, "_session"):
+          await self._session.close()
+          del self._session
+
+    def _lookup_statement(self, mapped_class, keyword_args):
+        '''
+        Internal convenience function to select objects using keyword arguments.
+        '''
+        statement = select(mapped_class)
+        for keyword, argument in keyword_args.items():
+          statement = statement.filter(getattr(mapped_class, keyword)==argument)
+        return statement
+
+    async def _lookup_unique(self, mapped_class, statement):
+        '''
+        Internal convenience function returning the object selected by
+        statement, or None if there is no such object. Fails by raising
+        MultipleResultsFound if the object isn't unique.
+        '''
+        result = await self.session.execute(statement.limit(2))
+        found = result.scalars().all()
+        if len(found) > 1:
+          raise MultipleResultsFound("Multiple '{}' objects were found when one was required.".format(mapped_class.__name__))
+        return found[0] if found else None
+
+    async def _get_or_create(self, mapped_class, keyword_args, create_args):
+        '''
+        Internal implementation of get_or_create(...), creating missing objects
+        using create_args.
+        '''
+        statement = self._lookup_statement(mapped_class, keyword_args)
+        unique_object = await self._lookup_unique(mapped_class, statement)
+        if unique_object is not None: return unique_object
+        unique_object = mapped_class(**create_args)
+        try:
+          # Insert within a SAVEPOINT, so a conflicting insert by a concurrent
+          # writer only rolls back this insert.
+          async with self.session.begin_nested():
+            self.session.add(unique_object)
+        except IntegrityError:
+          # If a concurrent writer created the object first, use it instead.
+          existing_object = await self._lookup_unique(mapped_class, statement)
+          if existing_object is None: raise
+          return existing_object
+        return unique_object
+
+    async def get_or_create(self, mapped_class, **keyword_args):
+        '''
+        Get or create a unique object from the database. See ORM.get_or_create(...).
+
+        Use:
+        >>> x = await orm.get_or_create(orm.Thing, name="Rumplestiltskin")
+        '''
+        return await self._get_or_create(mapped_class, keyword_args, keyword_args)
+
+    async def get_or_create_and_update(self, mapped_class, query_dict, update_dict):
+        '''
+        Get or create unique object with attributes from query_dict, and update
+        with attributes from update_dict. See ORM.get_or_create_and_update(...).
+
+        Use:
+        >>> x = await orm.get_or_create_and_update(orm.Thing, dict(name="Rumplestiltskin"), dict(attribute="Sneakiness"))
+        '''
+        self._check_attributes(mapped_class, update_dict)
+        create_dict = dict(query_dict)
+        create_dict.update(update_dict)
+        unique_object = await self._get_or_create(mapped_class, query_dict, create_dict)
+        self._update_object(unique_object, **update_dict)
+        return unique_object
@@ -0,0 +1,106 @@
+'''
+Write-behind buffering of ORM.get_or_create_and_update(...) calls, which are
+then written to the database in batches.
+'''
+from collections import OrderedDict
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+class WriteBehindBuffer(object):
+    '''
+    Buffers get_or_create_and_update(...) calls for an ORM, keyed by mapped
+    class and query dict, merging updates of the same object. Every size
+    distinct objects, or upon flush(), looks up the buffered objects with one
+    query per chunk_size objects of a class, then inserts missing objects with
+    bulk_insert_mappings(...), and updates existing objects with
+    bulk_update_mappings(...).
+
+    ORM.batch(...) makes one per session, and yields it, so its flush() can
+    write buffered calls before the context ends.
+    '''
+    def __init__(self, orm, size = 5000, chunk_size = 500):
+        self.orm = orm
+        self.size = size
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict()
+
+    def add(self, mapped_class, query_dict, update_dict):
+        '''
+        Buffers get_or_create_and_update(mapped_class, query_dict, update_dict).
+        Fails with AttributeError if keys of query_dict or update_dict aren't
+        column attributes of mapped_class.
+        '''
+        columns = class_mapper(mapped_class).columns
+        for key in list(query_dict) + list(update_dict):
+          if key not in columns:
+            raise AttributeError("Cannot update object: '{}' ORM objects have no column attribute '{}'.".format(mapped_class.__name__, key))
+        if not query_dict or None in query_dict.values():
+          # "IN" can't match NULL, so write these right away.
+          create_dict = dict(query_dict)
+          create_dict.update(update_dict)
+          unique_object = self.orm._get_or_create(mapped_class, query_dict, create_dict)
+          self.orm._update_object(unique_object, **update_dict)
+          return
+        key = (mapped_class, frozenset(query_dict.items()))
+        if key in self.entries:
+          self.entries[key][1].update(update_dict)
+        else:
+          self.entries[key] = (query_dict, dict(update_dict))
+          if len(self.entries) >= self.size: self.flush()
+
+    def discard(self):
+        '''Discards buffered calls.'''
+        self.entries.clear()
+
+    def flush(self):
+        '''Writes buffered calls to the database, and empties the buffer.'''
+        session = self.orm.session
+        # Flush first, so lookups see pending objects.
+        session.flush()
+        groups = OrderedDict()
+        for (mapped_class, _), (query_dict, update_dict) in self.entries.items():
+          groups.setdefault((mapped_class, tuple(sorted(query_dict))), list()).append((query_dict, update_dict))
+        self.entries.clear()
+        for (mapped_class, query_keys), pairs in groups.items():
+          self._write(session, mapped_class, query_keys, pairs)
+
+    def _write(self, session, mapped_class, query_keys, pairs):
+        '''
+        Internal function writing (query_dict, update_dict) pairs for objects
+        of mapped_class, whose query dicts have keys query_keys.
+        '''
+        mapper = class_mapper(mapped_class)
+        pk_keys = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+        query_columns = [mapper.columns[key] for key in query_keys]
+        # Look up primary keys of existing objects, chunk_size at a time.
+        found = dict()
+        keys = [tuple(query_dict[key] for key in query_keys) for query_dict, _ in pairs]
+        for start in range(0, len(keys), self.chunk_size):
+          chunk = keys[start:start + self.chunk_size]
+          if len(query_columns) == 1: criterion = query_columns[0].in_([key[0] for key in chunk])
+          else: criterion = tuple_(*query_columns).in_(chunk)
+          statement = select(*(list(mapper.primary_key) + query_columns)).where(criterion)
+          for row in session.execute(statement):
+            key = tuple(row[len(pk_keys):])
+            if key in found:
+              raise MultipleResultsFound("Multiple '{}' objects were found for {}.".format(mapped_class.__name__, dict(zip(query_keys, key))))
+            found[key] = dict(zip(pk_keys, row[:len(pk_keys)]))
+        inserts, updates = list(), list()
+        for key, (query_dict, update_dict) in zip(keys, pairs):
+          if key in found:
+            if update_dict:
+              values = dict(found[key])
+              values.update(update_dict)
+              updates.append(values)
+          else:
+            values = dict(query_dict)
+            values.update(update_dict)
+            inserts.append(values)
+        if inserts: session.bulk_insert_mappings(mapped_class, inserts)
+        if updates:
+          session.bulk_update_mappings(mapped_class, updates)
+          # Objects already in the session are stale now.
+          for obj in list(session.identity_map.values()):
+            if isinstance(obj, mapped_class): session.expire(obj)
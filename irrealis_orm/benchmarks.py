@@ -0,0 +1,232 @@
+'''
+Benchmarks of ORM hot paths, run against generated SQLite database files.
+
+Use:
+$ python -m irrealis_orm.benchmarks --output results.json
+$ python -m irrealis_orm.benchmarks --compare results.json --tolerance 0.2
+$ python -m irrealis_orm.benchmarks --reflection --tables 1000 --threads 8 --latency 1
+
+The suite times ORM construction against databases of 10, 100, and 1000
+tables, get_or_create(...) hits and misses and get_or_create_and_update(...)
+against tables of 10^3 to 10^6 rows, and create_mapped_classes(...) with
+growing numbers of definitions. Results are written as JSON, and compared to
+a stored baseline, reporting results worse than the baseline by more than a
+tolerance as regressions.
+'''
+import argparse, json, os, random, shutil, sys, tempfile, time
+
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, Table, Text, create_engine, event
+
+from irrealis_orm import ORM
+
+def create_database(path, tables, rows = 0):
+    '''
+    Creates an SQLite database file at path, with the given number of tables,
+    each referring to the previous table by foreign key, and the given number
+    of rows, named "Name 0", "Name 1", and so on, in the first table.
+    '''
+    metadata = MetaData()
+    for number in range(tables):
+      columns = [
+        Column("id", Integer, primary_key = True),
+        Column("name", Text, unique = True),
+        Column("value", Text),
+      ]
+      if number: columns.append(Column("parent_id", Integer, ForeignKey("table_{:04d}.id".format(number - 1))))
+      Table("table_{:04d}".format(number), metadata, *columns)
+    engine = create_engine("sqlite:///" + path)
+    metadata.create_all(engine)
+    table = metadata.tables["table_0000"]
+    for start in range(0, rows, 10000):
+      with engine.begin() as connection:
+        connection.execute(table.insert(), [dict(name = "Name {}".format(number)) for number in range(start, min(rows, start + 10000))])
+    engine.dispose()
+
+def best_time(function, repeat = 3):
+    '''Returns the best wall-clock time, in seconds, of repeated calls to function.'''
+    times = list()
+    for _ in range(repeat):
+      start = time.time()
+      function()
+      times.append(time.time() - start)
+    return min(times)
+
+def simulate_latency(engine, latency):
+    '''
+    Delays each statement executed by engine by latency seconds, to simulate
+    round trips to a database server, which a local SQLite file doesn't have.
+    '''
+    if latency: event.listen(engine, "before_cursor_execute", lambda *args: time.sleep(latency))
+
+def thing_defs():
+    return dict(Thing = dict(__tablename__ = "table_0000"))
+
+def bench_reflection(path, threads, repeat = 3, latency = 0):
+    '''
+    Times construction of an ORM mapping one table of the database at path,
+    with serial reflection and with parallel reflection by the given number of
+    threads. Returns a dict of the best times, in seconds.
+    '''
+    def construct(reflection_threads):
+        engine = create_engine("sqlite:///" + path)
+        simulate_latency(engine, latency)
+        ORM(thing_defs(), engine, reflection_threads = reflection_threads)
+        engine.dispose()
+    return dict(
+      serial = best_time(lambda: construct(None), repeat),
+      parallel = best_time(lambda: construct(threads), repeat),
+    )
+
+def bench_construction(path, repeat = 3):
+    '''
+    Returns the best time, in seconds, of ORM(orm_defs, engine) mapping one
+    table of the database at path, and reflecting the rest.
+    '''
+    def construct():
+        engine = create_engine("sqlite:///" + path)
+        ORM(thing_defs(), engine)
+        engine.dispose()
+    return best_time(construct, repeat)
+
+def bench_lookups(path, rows, lookups = 1000, repeat = 3):
+    '''
+    Measures calls per second of get_or_create(...) finding existing objects
+    ("hit"), get_or_create(...) creating missing objects ("miss"), and
+    get_or_create_and_update(...) on a mix of both ("update"), against the
+    first table of the database at path, which has the given number of rows.
+    Changes are rolled back after each run, so each run sees the database as
+    it was. Fails with RuntimeError if the number of rows changed anyway,
+    since misses would then have been hits.
+    '''
+    generator = random.Random(0)
+    existing = ["Name {}".format(generator.randrange(rows)) for _ in range(lookups)] if rows else list()
+    missing = ["Missing {}".format(number) for number in range(lookups)]
+    mixed = [name for pair in zip(existing, missing) for name in pair][:lookups]
+    engine = create_engine("sqlite:///" + path)
+    orm = ORM(thing_defs(), engine, lazy_reflection = True)
+    count_rows = lambda: orm.session.query(orm.Thing).count()
+    before = count_rows()
+    orm.session.rollback()
+    def calls(names, function):
+        def run_calls():
+            for name in names: function(name)
+            orm.session.rollback()
+        return run_calls
+    hit = calls(existing, lambda name: orm.get_or_create(orm.Thing, name = name))
+    miss = calls(missing, lambda name: orm.get_or_create(orm.Thing, name = name))
+    update = calls(mixed, lambda name: orm.get_or_create_and_update(orm.Thing, dict(name = name), dict(value = "Value")))
+    try:
+      rates = dict(
+        hit = len(existing) / best_time(hit, repeat) if existing else None,
+        miss = len(missing) / best_time(miss, repeat),
+        update = len(mixed) / best_time(update, repeat),
+      )
+      after = count_rows()
+      if after != before:
+        raise RuntimeError("Lookup benchmarks changed the number of rows from {} to {}.".format(before, after))
+      return rates
+    finally:
+      orm.remove_session()
+      engine.dispose()
+
+def bench_create_mapped_classes(definitions, repeat = 3):
+    '''
+    Returns the best time, in seconds, of create_mapped_classes(...) for the
+    given number of class definitions, without an engine.
+    '''
+    orm_defs = lambda: dict(
+      ("Thing{}".format(number), dict(__tablename__ = "table_{:04d}".format(number)))
+      for number in range(definitions)
+    )
+    def create():
+        ORM().create_mapped_classes(orm_defs())
+    return best_time(create, repeat)
+
+def run_suite(tables = (10, 100, 1000), rows = (1000, 10000, 100000, 1000000), definitions = (10, 100, 1000), lookups = 1000, repeat = 3, progress = None):
+    '''
+    Runs the benchmark suite in a temporary directory, and returns a dict
+    mapping benchmark names to dicts of "value" and "unit", either "seconds",
+    where less is better, or "per_second", where more is better. Calls
+    progress, if given, with each benchmark's name as it starts.
+    '''
+    results = dict()
+    def record(name, value, unit):
+        if value is not None: results[name] = dict(value = value, unit = unit)
+    def start(name):
+        if progress is not None: progress(name)
+    tmpdir = tempfile.mkdtemp()
+    try:
+      for count in tables:
+        start("construction/tables={}".format(count))
+        path = os.path.join(tmpdir, "tables_{}.db".format(count))
+        create_database(path, count)
+        record("construction/tables={}".format(count), bench_construction(path, repeat), "seconds")
+      for count in rows:
+        start("lookups/rows={}".format(count))
+        path = os.path.join(tmpdir, "rows_{}.db".format(count))
+        create_database(path, 1, count)
+        rates = bench_lookups(path, count, lookups, repeat)
+        record("get_or_create_hit/rows={}".format(count), rates["hit"], "per_second")
+        record("get_or_create_miss/rows={}".format(count), rates["miss"], "per_second")
+        record("get_or_create_and_update/rows={}".format(count), rates["update"], "per_second")
+      for count in definitions:
+        start("create_mapped_classes/definitions={}".format(count))
+        record("create_mapped_classes/definitions={}".format(count), bench_create_mapped_classes(count, repeat), "seconds")
+    finally:
+      shutil.rmtree(tmpdir)
+    return results
+
+def compare(baseline, results, tolerance = 0.2):
+    '''
+    Compares results to baseline, both as returned by run_suite(...), and
+    returns a sorted list of (name, baseline value, result value) for
+    benchmarks worse than baseline by more than the given fraction.
+    Benchmarks missing from either are skipped.
+    '''
+    regressions = list()
+    for name in sorted(set(baseline) & set(results)):
+      old, new = baseline[name]["value"], results[name]["value"]
+      if results[name]["unit"] == "seconds": worse = new > old * (1 + tolerance)
+      else: worse = new < old * (1 - tolerance)
+      if worse: regressions.append((name, old, new))
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark ORM hot paths against generated SQLite databases.")
+    parser.add_argument("--tables", type = int, nargs = "+", default = [10, 100, 1000], help = "numbers of tables of databases to construct ORMs for")
+    parser.add_argument("--rows", type = int, nargs = "+", default = [1000, 10000, 100000, 1000000], help = "numbers of rows of tables to look up objects in")
+    parser.add_argument("--definitions", type = int, nargs = "+", default = [10, 100, 1000], help = "numbers of class definitions to create mapped classes for")
+    parser.add_argument("--lookups", type = int, default = 1000, help = "number of calls per lookup benchmark")
+    parser.add_argument("--repeat", type = int, default = 3, help = "number of timed runs, of which the best is reported")
+    parser.add_argument("--output", help = "file to write results to, as JSON")
+    parser.add_argument("--compare", metavar = "BASELINE", help = "JSON results file to compare results to")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "fraction by which results may be worse than the baseline")
+    parser.add_argument("--reflection", action = "store_true", help = "instead compare serial and parallel reflection of the first --tables count")
+    parser.add_argument("--threads", type = int, default = 8, help = "number of threads for parallel reflection")
+    parser.add_argument("--latency", type = float, default = 0, help = "simulated round-trip time per statement, in milliseconds")
+    args = parser.parse_args(argv)
+    if args.reflection:
+      tmpdir = tempfile.mkdtemp()
+      try:
+        path = os.path.join(tmpdir, "benchmark.db")
+        create_database(path, args.tables[0])
+        times = bench_reflection(path, args.threads, args.repeat, args.latency / 1000.)
+      finally:
+        shutil.rmtree(tmpdir)
+      print("Reflection of {} tables: serial {:.3f}s, {} threads {:.3f}s".format(args.tables[0], times["serial"], args.threads, times["parallel"]))
+      return 0
+    results = run_suite(args.tables, args.rows, args.definitions, args.lookups, args.repeat, progress = lambda name: sys.stderr.write(name + "\n"))
+    for name in sorted(results):
+      print("{:45} {:12.3f} {}".format(name, results[name]["value"], results[name]["unit"]))
+    if args.output:
+      with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent = 2, sort_keys = True)
+    if args.compare:
+      with open(args.compare) as baseline_file:
+        regressions = compare(json.load(baseline_file), results, args.tolerance)
+      for name, old, new in regressions:
+        print("Regression: {} was {:.3f}, now {:.3f}".format(name, old, new))
+      if regressions: return 1
+    return 0
+
+if __name__ == "__main__": sys.exit(main())
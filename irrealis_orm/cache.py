@@ -0,0 +1,101 @@
+'''
+Caching of the primary keys of objects found or created by
+ORM.get_or_create(...), keyed by the keyword arguments that identified them.
+'''
+import threading, time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+
+class KeyCache(object):
+    '''
+    LRU cache of up to size entries, each mapping a mapped class and natural
+    key, the keyword arguments that uniquely identify an object, to the
+    object's primary key. If ttl is given, entries expire ttl seconds after
+    they're cached. Counts hits and misses.
+
+    ORM(..., key_cache_size=..., key_cache_ttl=...) keeps one as
+    orm.key_cache, whose stats() show how often lookups skip the database.
+    '''
+    def __init__(self, size = 10000, ttl = None, clock = None):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock or getattr(time, "monotonic", time.time)
+        self.hits = 0
+        self.misses = 0
+        # Maps natural keys to (identity key, expiry time), least recently used
+        # first; and identity keys to their natural keys, for invalidation.
+        self._entries = OrderedDict()
+        self._natural_keys = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def natural_key(mapped_class, keyword_args):
+        '''
+        Returns the cache key for an object of mapped_class identified by
+        keyword_args, or None if keyword_args can't be hashed.
+        '''
+        key = (mapped_class, frozenset(keyword_args.items()))
+        try:
+          hash(key)
+        except TypeError:
+          return None
+        return key
+
+    def get(self, natural_key):
+        '''
+        Returns the primary key cached for natural_key, or None, counting a
+        hit or miss.
+        '''
+        with self._lock:
+          entry = self._entries.get(natural_key)
+          if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+            self._remove(natural_key)
+            entry = None
+          if entry is None:
+            self.misses += 1
+            return None
+          self.hits += 1
+          self._entries[natural_key] = self._entries.pop(natural_key)
+          return entry[0][1]
+
+    def put(self, natural_key, obj):
+        '''Caches the primary key of persistent object obj for natural_key.'''
+        identity_key = inspect(obj).key
+        if natural_key is None or identity_key is None: return
+        with self._lock:
+          self._remove(natural_key)
+          expiry = self.clock() + self.ttl if self.ttl is not None else None
+          self._entries[natural_key] = (identity_key, expiry)
+          self._natural_keys.setdefault(identity_key, set()).add(natural_key)
+          while len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, natural_key):
+        '''Removes the entry for natural_key, if any.'''
+        with self._lock:
+          self._remove(natural_key)
+
+    def invalidate_object(self, obj):
+        '''Removes entries for object obj, if any.'''
+        identity_key = inspect(obj).key
+        with self._lock:
+          for natural_key in list(self._natural_keys.get(identity_key, ())):
+            self._remove(natural_key)
+
+    def clear(self):
+        '''Removes all entries.'''
+        with self._lock:
+          self._entries.clear()
+          self._natural_keys.clear()
+
+    def stats(self):
+        '''Returns a dict of hits, misses, and the number of entries.'''
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+    def _remove(self, natural_key):
+        entry = self._entries.pop(natural_key, None)
+        if entry is None: return
+        natural_keys = self._natural_keys.get(entry[0])
+        natural_keys.discard(natural_key)
+        if not natural_keys: del self._natural_keys[entry[0]]
@@ -0,0 +1,270 @@
+'''
+Tools to speed up loading database table info into ORMs, by copying table
+info from previously reflected metadata instead of reflecting it again.
+'''
+import os, pickle, tempfile, threading
+from multiprocessing.pool import ThreadPool
+
+import sqlalchemy
+from sqlalchemy import Index, MetaData, PrimaryKeyConstraint, Table, inspect, text, util
+from sqlalchemy.ext.declarative import DeferredReflection
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+def schema_fingerprint(engine):
+    '''
+    Returns a string that changes whenever the schema of the database given by
+    engine changes, or None if there is no cheap way to tell.
+
+    SQLite databases increment "PRAGMA schema_version" upon any schema change.
+    PostgreSQL databases are checksummed from their catalog of columns and
+    constraints in the current schema. In-memory databases aren't shared
+    between processes, so have no fingerprint.
+    '''
+    dialect = engine.dialect.name
+    with engine.connect() as connection:
+      if dialect == "sqlite":
+        if engine.url.database in (None, "", ":memory:"): return None
+        version = connection.execute(text("PRAGMA schema_version")).scalar()
+      elif dialect == "postgresql":
+        version = connection.execute(text(
+          "SELECT md5("
+          "coalesce((SELECT string_agg(table_name || '.' || column_name || ':' || data_type || ':' || is_nullable, ',' ORDER BY table_name, ordinal_position)"
+          " FROM information_schema.columns WHERE table_schema = current_schema()), '')"
+          " || '/' ||"
+          " coalesce((SELECT string_agg(table_name || '.' || constraint_name || ':' || constraint_type, ',' ORDER BY table_name, constraint_name)"
+          " FROM information_schema.table_constraints WHERE table_schema = current_schema()), ''))"
+        )).scalar()
+      else:
+        return None
+    # The same schema version in another database, or pickled by another
+    # SQLAlchemy version, isn't the same schema.
+    return "{}|{}|{}".format(sqlalchemy.__version__, repr(engine.url), version)
+
+def table_signatures(engine):
+    '''
+    Returns a dict mapping each table name in the database given by engine to
+    a string that changes whenever the table's schema changes, or None if
+    there is no cheap way to tell.
+
+    SQLite signatures are the SQL statements creating the table and its
+    indexes, from sqlite_master. PostgreSQL signatures are checksummed from
+    the catalog of the table's columns and constraints.
+    '''
+    dialect = engine.dialect.name
+    signatures = dict()
+    with engine.connect() as connection:
+      if dialect == "sqlite":
+        rows = connection.execute(text(
+          "SELECT tbl_name, type, name, sql FROM sqlite_master"
+          " WHERE type IN ('table', 'index') AND tbl_name NOT LIKE 'sqlite_%'"
+          " ORDER BY tbl_name, type DESC, name"
+        ))
+        for table_name, item_type, name, sql in rows:
+          if item_type == "table": signatures[table_name] = sql
+          elif table_name in signatures: signatures[table_name] += "\n{}: {}".format(name, sql)
+      elif dialect == "postgresql":
+        rows = connection.execute(text(
+          "SELECT c.table_name, md5(string_agg(c.column_name || ':' || c.data_type || ':' || c.is_nullable, ',' ORDER BY c.ordinal_position)"
+          " || '/' || coalesce((SELECT string_agg(t.constraint_name || ':' || t.constraint_type, ',' ORDER BY t.constraint_name)"
+          " FROM information_schema.table_constraints t WHERE t.table_schema = c.table_schema AND t.table_name = c.table_name), ''))"
+          " FROM information_schema.columns c JOIN information_schema.tables i"
+          " ON i.table_schema = c.table_schema AND i.table_name = c.table_name AND i.table_type = 'BASE TABLE'"
+          " WHERE c.table_schema = current_schema() GROUP BY c.table_schema, c.table_name"
+        ))
+        signatures.update(rows)
+      else:
+        return None
+    return signatures
+
+def load_reflection_cache(path, fingerprint):
+    '''
+    Returns a dict of the metadata and table signatures cached at path, if
+    they were saved with the given fingerprint, or None otherwise. Unreadable
+    caches are ignored.
+    '''
+    if fingerprint is None or not os.path.exists(path): return None
+    try:
+      with open(path, "rb") as cache_file:
+        cached = pickle.load(cache_file)
+    except Exception:
+      return None
+    if cached.get("fingerprint") != fingerprint: return None
+    return cached
+
+def save_reflection_cache(path, fingerprint, metadata, signatures = None):
+    '''
+    Caches metadata and table signatures at path, with the given fingerprint.
+    The cache file is replaced atomically, so concurrent processes never read
+    partial caches.
+    '''
+    if fingerprint is None: return
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".reflection-")
+    try:
+      with os.fdopen(handle, "wb") as cache_file:
+        cached = dict(fingerprint=fingerprint, metadata=metadata, signatures=signatures)
+        pickle.dump(cached, cache_file, pickle.HIGHEST_PROTOCOL)
+      getattr(os, "replace", os.rename)(tmp_path, path)
+    except Exception:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+
+def copy_table(source, metadata):
+    '''
+    Copies info for table source into metadata, and returns the copied table.
+
+    If metadata already has a table of the same name, it is extended with the
+    columns it lacks, and with constraints and indexes on those columns, much
+    as DeferredReflection extends tables of mapped classes.
+    '''
+    if source.key not in metadata.tables: return source.to_metadata(metadata)
+    table = metadata.tables[source.key]
+    existing = set(table.columns.keys())
+    for column in source.columns:
+      if column.key not in existing: table.append_column(column._copy())
+    def copyable(item): return not existing.intersection(column.key for column in item.columns)
+    for constraint in source.constraints:
+      # Primary keys come with their columns. So do constraints generated by
+      # column flags, like "unique=True".
+      if isinstance(constraint, PrimaryKeyConstraint) or constraint._type_bound or getattr(constraint, "_column_flag", False): continue
+      if copyable(constraint): table.append_constraint(constraint._copy(target_table=table))
+    for index in source.indexes:
+      if index._column_flag or not copyable(index): continue
+      Index(index.name, *[table.columns[column.key] for column in index.columns], unique=index.unique, **index.kwargs)
+    return table
+
+class ReflectedTables(object):
+    '''
+    Tables reflected into several MetaData, which can be looked up by key
+    through the tables attribute, as with MetaData, and copied from.
+    '''
+    def __init__(self, metadatas):
+        self.tables = dict()
+        for metadata in metadatas: self.tables.update(metadata.tables)
+
+def reflect_parallel(engine, names, threads):
+    '''
+    Reflects the tables named by names from the database given by engine, and
+    returns them as ReflectedTables. Tables are inspected by a pool of the
+    given number of threads, each using its own pooled connection.
+
+    Databases whose connection pool can't hand out independent connections,
+    such as in-memory SQLite databases, are reflected by the calling thread.
+    '''
+    def reflect(names):
+        metadata = MetaData()
+        with engine.connect() as connection:
+          for name in names:
+            # Referred tables are reflected by their own tasks.
+            Table(name, metadata, autoload_with=connection, resolve_fks=False)
+        return metadata
+    names = list(names)
+    if threads > 1 and len(names) > 1 and not isinstance(engine.pool, (SingletonThreadPool, StaticPool)):
+      # One connection and one share of the tables per thread.
+      threads = min(threads, len(names))
+      pool = ThreadPool(threads)
+      try:
+        partial = pool.map(reflect, [names[start::threads] for start in range(threads)])
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      partial = [reflect(names)]
+    return ReflectedTables(partial)
+
+class PreloadedReflection(DeferredReflection):
+    '''
+    DeferredReflection that copies table info from preloaded metadata, when
+    given, instead of reflecting it from the database.
+
+    Use:
+    >>> Base = declarative_base(cls=PreloadedReflection)
+    >>> Base._preloaded_metadata = metadata
+    >>> Base.prepare(engine)
+    '''
+    _preloaded_metadata = None
+
+    @classmethod
+    def _reflect_table(cls, table, inspector):
+        preloaded = cls._preloaded_metadata
+        if preloaded is not None and table.key in preloaded.tables:
+          copy_table(preloaded.tables[table.key], table.metadata)
+        else:
+          super(PreloadedReflection, cls)._reflect_table(table, inspector)
+
+class LazyTables(util.FacadeDict):
+    '''
+    Tables of a LazyMetaData, which are loaded the first time they are looked
+    up, either by "in" or by key.
+    '''
+    def _configure(self, **attributes):
+        # FacadeDicts are otherwise immutable.
+        for name, value in attributes.items(): object.__setattr__(self, name, value)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._load(key)
+
+    def __missing__(self, key):
+        if self._load(key): return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def _load(self, key):
+        '''
+        Loads the table named key into metadata, from preloaded metadata if
+        possible, or else by reflection. Returns False if the table can't be
+        found.
+        '''
+        if self._engine is None: return False
+        with self._lock:
+          if key in self._loading or dict.__contains__(self, key): return dict.__contains__(self, key)
+          if self._preloaded is not None and key in self._preloaded.tables:
+            source = self._preloaded.tables[key]
+          else:
+            if self._names is None: self._configure(_names = set(inspect(self._engine).get_table_names()))
+            if key not in self._names: return False
+            source = None
+          # Table lookups made while loading this table mustn't load it again.
+          self._loading.add(key)
+          try:
+            if source is not None: copy_table(source, self._metadata)
+            else: Table(key, self._metadata, autoload_with=self._engine)
+          finally:
+            self._loading.discard(key)
+        return True
+
+class LazyMetaData(MetaData):
+    '''
+    MetaData that, once given an engine by reflect_lazily(...), loads tables
+    from the database the first time they are looked up in its tables, rather
+    than all at once.
+
+    Use:
+    >>> metadata = LazyMetaData()
+    >>> metadata.reflect_lazily(engine)
+    >>> table = metadata.tables["things"]
+    '''
+    def __init__(self, *args, **kwargs):
+        super(LazyMetaData, self).__init__(*args, **kwargs)
+        self.tables = LazyTables()
+        self.tables._configure(
+          _metadata = self, _engine = None, _preloaded = None,
+          _names = None, _loading = set(), _lock = threading.RLock(),
+        )
+
+    def loaded(self, key):
+        '''Returns True if the table named key is loaded, without loading it.'''
+        return dict.__contains__(self.tables, key)
+
+    def known_names(self):
+        '''Returns the names of tables last known to be in the database.'''
+        return set(self.tables._names or ())
+
+    def reflect_lazily(self, engine, preloaded = None):
+        '''
+        Loads tables from the database given by engine as they're looked up,
+        copying them from preloaded metadata when it has them.
+        '''
+        self.tables._configure(_engine = engine, _preloaded = preloaded, _names = None)
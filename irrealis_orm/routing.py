@@ -0,0 +1,96 @@
+'''
+Routing of ORM sessions' reads to read replicas of a primary database, and
+of their writes to the primary.
+'''
+import itertools, threading, time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import TextClause
+
+class ReplicaRouter(object):
+    '''
+    Chooses among replica engines for reads, either in turn if selection is
+    "round_robin", or by fewest connections in use if selection is
+    "least_busy". If read_your_writes is a number of seconds, sessions read
+    from the primary for that long after committing writes, so they see their
+    own writes despite replication lag.
+
+    ORM(..., replicas=...) makes one as orm.router, shared by the sessions
+    of orm.session_factory.
+    '''
+    def __init__(self, replicas, selection = "round_robin", read_your_writes = None, clock = None):
+        if selection not in ("round_robin", "least_busy"):
+          raise ValueError("Unknown replica selection '{}'; expected 'round_robin' or 'least_busy'.".format(selection))
+        self.replicas = list(replicas)
+        self.selection = selection
+        self.read_your_writes = read_your_writes
+        self.clock = clock or getattr(time, "monotonic", time.time)
+        self._turns = itertools.count()
+        self._busy = dict((id(replica), 0) for replica in self.replicas)
+        self._lock = threading.Lock()
+        if selection == "least_busy":
+          for replica in self.replicas:
+            event.listen(replica, "checkout", self._counter(replica, 1))
+            event.listen(replica, "checkin", self._counter(replica, -1))
+
+    def _counter(self, replica, step):
+        def count(*args):
+            with self._lock: self._busy[id(replica)] += step
+        return count
+
+    def busy(self, replica):
+        '''Returns the number of connections to replica in use.'''
+        return self._busy[id(replica)]
+
+    def choose(self):
+        '''Returns the replica engine for the next read.'''
+        turn = next(self._turns) % len(self.replicas)
+        if self.selection == "round_robin": return self.replicas[turn]
+        # Ties go to replicas in turn.
+        candidates = self.replicas[turn:] + self.replicas[:turn]
+        with self._lock:
+          return min(candidates, key=lambda replica: self._busy[id(replica)])
+
+class RoutingSession(Session):
+    '''
+    Session that reads from replicas chosen by router, and writes to its bind,
+    the primary. Each transaction reads from one replica, chosen by its first
+    read, so it sees consistent data. Flushes, statements other than SELECTs,
+    and every statement after the first write of a transaction go to the
+    primary.
+
+    Use:
+    >>> factory = sessionmaker(primary, class_=RoutingSession, router=ReplicaRouter(replicas))
+    '''
+    def __init__(self, bind = None, router = None, **kwargs):
+        super(RoutingSession, self).__init__(bind=bind, **kwargs)
+        self.router = router
+        self._wrote = False
+        self._replica = None
+        self._primary_until = None
+
+    def get_bind(self, mapper = None, clause = None, **kwargs):
+        primary = super(RoutingSession, self).get_bind(mapper, clause=clause, **kwargs)
+        if self.router is None or not self.router.replicas: return primary
+        if self._flushing or getattr(clause, "is_dml", False) or isinstance(clause, TextClause):
+          self._wrote = True
+          return primary
+        if self._wrote or not getattr(clause, "is_select", False): return primary
+        if self._primary_until is not None and self.router.clock() < self._primary_until: return primary
+        if self._replica is None: self._replica = self.router.choose()
+        return self._replica
+
+@event.listens_for(RoutingSession, "after_commit")
+def _after_commit(session):
+    # Releasing a SAVEPOINT doesn't end the transaction.
+    if session.in_nested_transaction(): return
+    if session._wrote and session.router is not None and session.router.read_your_writes:
+      session._primary_until = session.router.clock() + session.router.read_your_writes
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _after_transaction_end(session, transaction):
+    # The next transaction, after commit, rollback, or close, starts afresh.
+    if transaction.parent is None:
+      session._wrote = False
+      session._replica = None
@@ -0,0 +1,151 @@
+'''
+Instrumentation of what an ORM does to its database: statements executed and
+their latencies, objects loaded, flushes, slow statements, and relationships
+lazily loaded so often they suggest N+1 query patterns.
+'''
+import threading, time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.sql.util import find_tables
+
+# Upper bounds, in seconds, of latency histogram buckets. The last bucket,
+# None, counts slower statements.
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, None)
+
+def new_timing():
+    return dict(count=0, seconds=0., histogram=dict((bound, 0) for bound in LATENCY_BUCKETS))
+
+def add_timing(timing, seconds):
+    timing["count"] += 1
+    timing["seconds"] += seconds
+    for bound in LATENCY_BUCKETS:
+      if bound is None or seconds <= bound:
+        timing["histogram"][bound] += 1
+        break
+
+class QueryStats(object):
+    '''
+    Collects statistics of statements executed by an engine, and of sessions
+    made by a session factory, for an ORM.
+
+    If slow_query_threshold is a number of seconds, slower statements are
+    logged, keeping the last slow_query_log_size of them. Relationships lazily
+    loaded lazy_load_threshold times for one session are reported as likely
+    N+1 query patterns.
+
+    ORM(..., instrument=True) keeps one as orm.query_stats, read by
+    orm.stats() and cleared by orm.reset_stats().
+    '''
+    def __init__(self, mapped_classes, slow_query_threshold = None, slow_query_log_size = 100, lazy_load_threshold = 10):
+        self.mapped_classes = mapped_classes
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_log_size = slow_query_log_size
+        self.lazy_load_threshold = lazy_load_threshold
+        # Names of mapped classes whose tables each statement uses.
+        self._statement_classes = dict()
+        self._lock = threading.Lock()
+        # Counted by reset(), so sessions' lazy load counts from before it are
+        # ignored.
+        self._generation = 0
+        self.reset()
+
+    def reset(self):
+        '''Discards statistics collected so far.'''
+        with self._lock:
+          self._generation += 1
+          self.statements = dict()
+          self.classes = dict()
+          self.total = new_timing()
+          self.rows = dict()
+          self.flushes = dict(count=0, objects=0, largest=0)
+          self.slow_queries = deque(maxlen=self.slow_query_log_size)
+          self.lazy_loads = dict()
+
+    def attach(self, engine, session_factory, Base):
+        '''
+        Listens for statements executed by engine, objects of classes derived
+        from Base being loaded, and flushes and relationship loads of sessions
+        made by session_factory.
+        '''
+        self.attach_engine(engine)
+        if not event.contains(Base, "load", self._load):
+          event.listen(Base, "load", self._load, propagate=True)
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+
+    def attach_engine(self, engine):
+        '''Listens for statements executed by engine, such as a read replica.'''
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def snapshot(self):
+        '''Returns a dict of the statistics collected so far.'''
+        def copy_timing(timing): return dict(timing, histogram=dict(timing["histogram"]))
+        with self._lock:
+          return dict(
+            queries=copy_timing(self.total),
+            statements=dict((statement, copy_timing(timing)) for statement, timing in self.statements.items()),
+            classes=dict((name, copy_timing(timing)) for name, timing in self.classes.items()),
+            rows=dict(self.rows),
+            flushes=dict(self.flushes),
+            slow_queries=list(self.slow_queries),
+            lazy_loads=dict(self.lazy_loads),
+            n_plus_one=[
+              "{} lazily loaded {} times in one session".format(relationship, count)
+              for relationship, count in sorted(self.lazy_loads.items()) if count >= self.lazy_load_threshold
+            ],
+          )
+
+    def _classes_of(self, statement, context):
+        '''Returns names of mapped classes whose tables statement uses.'''
+        names = self._statement_classes.get(statement)
+        if names is None:
+          compiled = getattr(context, "compiled", None)
+          clause = getattr(compiled, "statement", None)
+          tables = find_tables(clause, include_crud=True) if clause is not None else ()
+          names = sorted(set(
+            self.mapped_classes[table.name].__name__ for table in tables
+            if getattr(table, "name", None) in self.mapped_classes
+          ))
+          self._statement_classes[statement] = names
+        return names
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("irrealis_orm.query_start", list()).append(time.time())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        seconds = time.time() - connection.info["irrealis_orm.query_start"].pop()
+        names = self._classes_of(statement, context)
+        with self._lock:
+          add_timing(self.total, seconds)
+          add_timing(self.statements.setdefault(statement, new_timing()), seconds)
+          for name in names: add_timing(self.classes.setdefault(name, new_timing()), seconds)
+          if self.slow_query_threshold is not None and seconds >= self.slow_query_threshold:
+            self.slow_queries.append(dict(statement=statement, parameters=parameters, seconds=seconds))
+
+    def _load(self, target, context):
+        name = type(target).__name__
+        with self._lock:
+          self.rows[name] = self.rows.get(name, 0) + 1
+
+    def _after_flush(self, session, flush_context):
+        objects = len(session.new) + len(session.dirty) + len(session.deleted)
+        with self._lock:
+          self.flushes["count"] += 1
+          self.flushes["objects"] += objects
+          self.flushes["largest"] = max(self.flushes["largest"], objects)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_relationship_load or orm_execute_state.lazy_loaded_from is None: return
+        relationship = str(orm_execute_state.loader_strategy_path[-1])
+        # Count lazy loads per session since the last reset, and report the
+        # most for any session.
+        info = orm_execute_state.session.info
+        generation, counts = info.get("irrealis_orm.lazy_loads", (None, None))
+        if generation != self._generation:
+          counts = dict()
+          info["irrealis_orm.lazy_loads"] = (self._generation, counts)
+        counts[relationship] = counts.get(relationship, 0) + 1
+        with self._lock:
+          self.lazy_loads[relationship] = max(self.lazy_loads.get(relationship, 0), counts[relationship])
@@ -1,9 +1,24 @@
-from irrealis_orm import ORM
-from sqlalchemy import Table, Column, Integer, Text, MetaData, ForeignKey, create_engine
+from irrealis_orm import ORM, benchmarks
+try:
+  import asyncio, aiosqlite
+  from irrealis_orm.async_orm import AsyncORM
+except (ImportError, SyntaxError):
+  AsyncORM = None
+from sqlalchemy import Table, Column, Integer, Text, MetaData, ForeignKey, create_engine, event, inspect, select
 from sqlalchemy.orm import relationship
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.pool import QueuePool
 
-import unittest
+import gc, os, pickle, shutil, tempfile, threading, unittest
+
+def thing_defs():
+    '''ORM definitions for TestProcesses, which must be picklable.'''
+    return dict(Thing = dict(__tablename__ = 'thing'))
+
+def name_lengths(orm, things):
+    '''Partition function for TestProcesses.'''
+    return [len(thing.name) for thing in things]
 
 class TestORM(unittest.TestCase):
     '''
@@ -91,6 +106,74 @@ class TestORM(unittest.TestCase):
         orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
         self.exercise_orm(orm)
 
+    def test_orm_with_parallel_reflection(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+          engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'test.db'))
+          self.metadata.create_all(engine)
+          # Collect in-memory SQLite connections left by other tests now, since
+          # reflection threads can't close them.
+          gc.collect()
+          orm = ORM(self.orm_defs, engine, reflection_threads = 4)
+          self.assertEqual(set([u"users", u"addresses"]), set(orm.Base.metadata.tables))
+          self.exercise_orm(orm)
+          orm.session.close()
+          engine.dispose()
+        finally:
+          shutil.rmtree(tmpdir)
+
+
+class TestSessionScope(unittest.TestCase):
+    '''
+    Tests per-thread and per-scope sessions, and engine options.
+    '''
+    def setUp(self):
+        self.orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+          ),
+        )
+
+    def test_unscoped_session(self):
+        orm = ORM(self.orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        session = orm.session
+        self.assertTrue(orm.session is session)
+        orm.remove_session()
+        self.assertFalse(orm.session is session)
+
+    def test_thread_scoped_session(self):
+        orm = ORM(self.orm_defs, 'sqlite:///:memory:', deferred_reflection = False, session_scope = "thread")
+        session = orm.session
+        self.assertTrue(orm.session is session)
+        sessions = []
+        thread = threading.Thread(target = lambda: sessions.append(orm.session))
+        thread.start()
+        thread.join()
+        self.assertFalse(sessions[0] is session)
+        orm.remove_session()
+        self.assertFalse(orm.session is session)
+
+    def test_custom_scoped_session(self):
+        request = ["request 1"]
+        orm = ORM(self.orm_defs, 'sqlite:///:memory:', deferred_reflection = False, session_scope = lambda: request[0])
+        session = orm.session
+        self.assertTrue(orm.session is session)
+        request[0] = "request 2"
+        self.assertFalse(orm.session is session)
+        request[0] = "request 1"
+        self.assertTrue(orm.session is session)
+
+    def test_engine_options(self):
+        orm = ORM(
+          self.orm_defs, 'sqlite:///:memory:', deferred_reflection = False,
+          engine_options = dict(poolclass = QueuePool, pool_size = 3, max_overflow = 2, pool_recycle = 60, pool_pre_ping = True),
+        )
+        self.assertEqual(3, orm.engine.pool.size())
+        self.assertEqual(60, orm.engine.pool._recycle)
+        self.assertTrue(orm.engine.pool._pre_ping)
+
 
 class TestLoadUnmappedTables(unittest.TestCase):
     '''
@@ -121,6 +204,253 @@ class TestLoadUnmappedTables(unittest.TestCase):
         orm = ORM(orm_defs, engine)
         self.assertTrue(u"more_things" in orm.Base.metadata.tables)
 
+    def test_unmapped_tables_loaded_lazily(self):
+        metadata = MetaData()
+        Table("things", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("kind_id", Integer, ForeignKey("kinds.id")),
+        )
+        Table("kinds", metadata, Column("id", Integer, primary_key=True))
+        Table("things_association", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("parent_id", Integer, ForeignKey("things.id")),
+          Column("child_id", Integer, ForeignKey("things.id")),
+        )
+        Table("more_things", metadata, Column("id", Integer, primary_key=True))
+        engine = create_engine('sqlite:///:memory:')
+        metadata.create_all(engine)
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = "things",
+            children = relationship(
+              "Thing",
+              secondary = "things_association",
+              primaryjoin = "Thing.id==things_association.c.parent_id",
+              secondaryjoin = "Thing.id==things_association.c.child_id",
+            ),
+          ),
+        )
+        orm = ORM(orm_defs, engine, lazy_reflection = True)
+        # Mapped tables, the tables they refer to, and association tables are
+        # loaded eagerly. Other tables are loaded upon lookup.
+        self.assertEqual(set([u"things", u"kinds", u"things_association"]), set(dict(orm.Base.metadata.tables)))
+        self.assertTrue(u"more_things" in orm.Base.metadata.tables)
+        self.assertEqual([u"id"], orm.Base.metadata.tables[u"more_things"].columns.keys())
+        self.assertFalse(u"no_things" in orm.Base.metadata.tables)
+        thing = orm.Thing(children = [orm.Thing()])
+        orm.session.add(thing)
+        orm.session.commit()
+        self.assertEqual(1, len(thing.children))
+
+
+class TestLazyClasses(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM(..., lazy_classes=True), which builds and maps
+    each class in orm_defs the first time it is used, along with the classes
+    its relationships refer to.
+    '''
+    def setUp(self):
+        metadata = MetaData()
+        Table('users', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('name', Text),
+        )
+        Table('addresses', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('user_id', None, ForeignKey('users.id')),
+          Column('email', Text, nullable = False),
+        )
+        Table('others', metadata, Column('id', Integer, primary_key = True))
+        self.engine = create_engine('sqlite:///:memory:')
+        metadata.create_all(self.engine)
+        self.orm_defs = lambda: dict(
+          User = dict(
+            __tablename__ = 'users',
+            addresses = relationship("Address"),
+          ),
+          Address = dict(
+            __tablename__ = 'addresses',
+            user = relationship("User"),
+          ),
+          Other = dict(
+            __tablename__ = 'others',
+          ),
+        )
+
+    def exercise_orm(self, orm):
+        self.assertFalse(u"users" in orm.mapped_classes)
+        # Building User builds Address, which its relationship refers to.
+        user = orm.User(name = u"Name", addresses = [orm.Address(email = u"full.name@domain.com")])
+        self.assertEqual(set([u"users", u"addresses"]), set(orm.mapped_classes))
+        self.assertTrue(orm.mapped_classes[u"addresses"] is orm.Address)
+        orm.session.add(user)
+        orm.session.commit()
+        self.assertEqual(user, orm.get_or_create(orm.User, name = u"Name"))
+        self.assertTrue(orm.mapped_classes.get(u"others") is orm.Other)
+        self.assertEqual(None, orm.mapped_classes.get(u"nonsense"))
+        with self.assertRaises(AttributeError):
+          orm.Nonsense
+
+    def test_lazy_classes(self):
+        orm = ORM(self.orm_defs(), self.engine, lazy_classes = True)
+        self.exercise_orm(orm)
+
+    def test_lazy_classes_and_reflection(self):
+        orm = ORM(self.orm_defs(), self.engine, lazy_classes = True, lazy_reflection = True)
+        self.assertEqual([], list(dict(orm.Base.metadata.tables)))
+        self.exercise_orm(orm)
+
+    def test_lazy_classes_before_engine(self):
+        orm = ORM(self.orm_defs(), lazy_classes = True)
+        # Classes used before the ORM has an engine are mapped when it gets one.
+        orm.User
+        orm.configure_with_engine(self.engine)
+        self.assertEqual([u"id", u"name"], orm.Base.metadata.tables[u"users"].columns.keys())
+        self.assertEqual(set([u"users", u"addresses"]), set(orm.mapped_classes))
+
+    def test_lazy_classes_without_reflection(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+          ),
+        )
+        orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False, lazy_classes = True)
+        thing = orm.get_or_create(orm.Thing, name = u"Rumplestiltskin")
+        self.assertEqual(thing, orm.get_or_create(orm.Thing, name = u"Rumplestiltskin"))
+
+    def test_lazy_classes_concurrently(self):
+        # Threads using classes at once each get the one mapped class. Threads
+        # need a database file, since each has its own in-memory database, and
+        # slow statements widen the window for threads to race.
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'test.db'))
+        self.addCleanup(engine.dispose)
+        metadata = MetaData()
+        metadata.reflect(self.engine)
+        metadata.create_all(engine)
+        benchmarks.simulate_latency(engine, 0.005)
+        for trial in range(5):
+          orm = ORM(self.orm_defs(), engine, lazy_classes = True)
+          start, results, errors = threading.Event(), list(), list()
+          def use_classes(number):
+              start.wait()
+              try:
+                if number % 2: classes = (orm.Address, orm.mapped_classes[u"users"])
+                else: classes = (orm.mapped_classes[u"addresses"], orm.User)
+                # Classes are mapped by the time threads get them.
+                for mapped_class in classes: mapped_class.id
+                results.append(classes)
+              except Exception as e:
+                errors.append(e)
+          threads = [threading.Thread(target = use_classes, args = (number,)) for number in range(8)]
+          for thread in threads: thread.start()
+          start.set()
+          for thread in threads: thread.join()
+          self.assertEqual([], errors)
+          self.assertEqual(set([(orm.Address, orm.User)]), set(results))
+          self.assertEqual(set([u"users", u"addresses"]), set(orm.mapped_classes))
+
+
+class TestReflectionCache(unittest.TestCase):
+    '''
+    Tests that ORMs given a reflection cache file load table info from the
+    cache, instead of reflecting it, until the database schema changes.
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.tmpdir, 'test.db'))
+        self.cache = os.path.join(self.tmpdir, 'reflection.cache')
+        metadata = MetaData()
+        Table('users', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('name', Text),
+        )
+        Table('addresses', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('user_id', None, ForeignKey('users.id')),
+          Column('email', Text, nullable = False),
+        )
+        metadata.create_all(self.engine)
+        self.orm_defs = lambda: dict(
+          User = dict(__tablename__ = 'users', addresses = relationship("Address")),
+          Address = dict(__tablename__ = 'addresses', user = relationship("User")),
+        )
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_warm_start_skips_reflection(self):
+        ORM(self.orm_defs(), self.engine, reflection_cache = self.cache)
+        self.assertTrue(os.path.exists(self.cache))
+        del self.statements[:]
+        orm = ORM(self.orm_defs(), self.engine, reflection_cache = self.cache)
+        self.assertEqual(["PRAGMA schema_version"], self.statements)
+        user = orm.User(name = u"Name")
+        address = orm.Address(email = u"name@domain.com", user = user)
+        orm.session.add_all([user, address])
+        orm.session.commit()
+        self.assertTrue(address in user.addresses)
+
+    def test_schema_change_invalidates_cache(self):
+        ORM(self.orm_defs(), self.engine, reflection_cache = self.cache)
+        metadata = MetaData()
+        Table('things', metadata, Column('id', Integer, primary_key = True))
+        metadata.create_all(self.engine)
+        orm = ORM(self.orm_defs(), self.engine, reflection_cache = self.cache)
+        self.assertTrue(u"things" in orm.Base.metadata.tables)
+
+class TestRefreshSchema(unittest.TestCase):
+    '''
+    Tests that ORM.refresh_schema() reloads table info for only those tables
+    added, dropped, or altered since table info was loaded.
+    '''
+    def setUp(self):
+        metadata = MetaData()
+        Table("things", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("name", Text),
+        )
+        Table("old_things", metadata, Column("id", Integer, primary_key=True))
+        Table("same_things", metadata, Column("id", Integer, primary_key=True))
+        self.engine = create_engine('sqlite:///:memory:')
+        metadata.create_all(self.engine)
+        self.orm_defs = dict(Thing = dict(__tablename__ = "things"))
+
+    def alter_schema(self):
+        with self.engine.begin() as connection:
+          connection.exec_driver_sql("ALTER TABLE things ADD COLUMN color TEXT")
+          connection.exec_driver_sql("DROP TABLE old_things")
+          connection.exec_driver_sql("CREATE TABLE new_things (id INTEGER PRIMARY KEY)")
+
+    def check_refresh(self, orm):
+        same_things = orm.Base.metadata.tables[u"same_things"]
+        orm.get_or_create(orm.Thing, name = u"Old thing")
+        self.assertEqual((u"id", u"name"), orm.read_rows(orm.Thing)[0]._fields)
+        orm.session.commit()
+        self.alter_schema()
+        changes = orm.refresh_schema()
+        self.assertEqual(dict(added=[u"new_things"], dropped=[u"old_things"], altered=[u"things"]), changes)
+        self.assertTrue(u"new_things" in orm.Base.metadata.tables)
+        self.assertFalse(u"old_things" in orm.Base.metadata.tables)
+        self.assertTrue(orm.Base.metadata.tables[u"same_things"] is same_things)
+        # New columns of mapped tables are mapped.
+        thing = orm.Thing(name = u"Thing", color = u"Blue")
+        orm.session.add(thing)
+        orm.session.commit()
+        self.assertEqual(1, orm.session.query(orm.Thing).filter_by(color = u"Blue").count())
+        self.assertEqual([(u"Old thing", None), (u"Thing", u"Blue")], [(row.name, row.color) for row in orm.read_rows(orm.Thing)])
+
+    def test_refresh_schema(self):
+        self.check_refresh(ORM(self.orm_defs, self.engine))
+
+    def test_refresh_lazy_schema(self):
+        self.check_refresh(ORM(self.orm_defs, self.engine, lazy_reflection = True))
 
 
 class TestManyToManySelf(unittest.TestCase):
@@ -200,6 +530,161 @@ class TestManyToManySelf(unittest.TestCase):
         self.assertTrue(parent2 in child2.parents)
 
 
+class TestRelationshipLoading(unittest.TestCase):
+    '''
+    Tests and demonstrates loading strategies named in orm_defs by
+    "__loading__", and ORM.prefetch(self, objects, *paths).
+    '''
+    def setUp(self):
+        self.orm_defs = lambda loading: dict(
+          User = dict(
+            __tablename__ = 'users',
+            __loading__ = loading,
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            addresses = relationship("Address"),
+          ),
+          Address = dict(
+            __tablename__ = 'addresses',
+            id = Column('id', Integer, primary_key = True),
+            user_id = Column('user_id', None, ForeignKey('users.id')),
+            email = Column('email', Text),
+            user = relationship("User"),
+          ),
+        )
+
+    def create_orm(self, loading = None):
+        orm = ORM(self.orm_defs(loading or dict()), 'sqlite:///:memory:', deferred_reflection = False)
+        for number in range(5):
+          orm.session.add(orm.User(name = u"User {}".format(number), addresses = [orm.Address(email = u"{}@domain.com".format(number))]))
+        orm.session.commit()
+        self.statements = []
+        event.listen(orm.engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+        return orm
+
+    def test_selectin_loading(self):
+        orm = self.create_orm(dict(addresses = "selectin"))
+        emails = [address.email for user in orm.session.query(orm.User) for address in user.addresses]
+        self.assertEqual(5, len(emails))
+        self.assertEqual(2, len(self.statements))
+
+    def test_orm_defs_unchanged(self):
+        orm_defs = self.orm_defs(dict(addresses = "raise"))
+        addresses = orm_defs["User"]["addresses"]
+        ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        self.assertEqual("select", addresses.lazy)
+        # The same relationships may be loaded differently by another ORM.
+        orm_defs = self.orm_defs(dict(addresses = "selectin"))
+        orm_defs["User"]["addresses"] = addresses
+        orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        self.assertEqual("selectin", orm.User.addresses.property.lazy)
+
+    def test_raise_on_lazy_loading(self):
+        orm = self.create_orm(dict(addresses = "raise"))
+        user = orm.session.query(orm.User).first()
+        with self.assertRaises(InvalidRequestError):
+          user.addresses
+
+    def test_loading_errors(self):
+        with self.assertRaises(AttributeError):
+          ORM(self.orm_defs(dict(nonsense = "selectin")), deferred_reflection = False)
+        with self.assertRaises(ValueError):
+          ORM(self.orm_defs(dict(addresses = "nonsense")), deferred_reflection = False)
+
+    def test_prefetch(self):
+        orm = self.create_orm()
+        users = orm.session.query(orm.User).all()
+        del self.statements[:]
+        self.assertEqual(users, orm.prefetch(users, "addresses", "addresses.user"))
+        prefetch_statements = len(self.statements)
+        self.assertTrue(prefetch_statements <= 3)
+        users_again = [address.user for user in users for address in user.addresses]
+        self.assertEqual(users, users_again)
+        self.assertEqual(prefetch_statements, len(self.statements))
+        with self.assertRaises(AttributeError):
+          orm.prefetch(users, "addresses.nonsense")
+
+
+class TestReadReplicas(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM(..., replicas, replica_selection,
+    read_your_writes), which reads from replicas and writes to the primary.
+    These "replicas" are separate SQLite files holding different rows, so
+    the rows read show where they were read from.
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.urls = []
+        for name in ["primary", "replica_0", "replica_1"]:
+          url = 'sqlite:///' + os.path.join(self.tmpdir, name + '.db')
+          metadata = MetaData()
+          thing = Table('thing', metadata,
+            Column('id', Integer, primary_key = True),
+            Column('name', Text),
+          )
+          engine = create_engine(url)
+          metadata.create_all(engine)
+          with engine.begin() as connection:
+            connection.execute(thing.insert(), [dict(name = name)])
+          engine.dispose()
+          self.urls.append(url)
+        self.orm_defs = lambda: dict(Thing = dict(__tablename__ = 'thing'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_orm(self, **options):
+        orm = ORM(self.orm_defs(), self.urls[0], replicas = self.urls[1:], **options)
+        self.addCleanup(lambda: [engine.dispose() for engine in [orm.engine] + orm.router.replicas])
+        self.addCleanup(orm.remove_session)
+        return orm
+
+    def names(self, orm):
+        return [thing.name for thing in orm.session.query(orm.Thing)]
+
+    def test_round_robin(self):
+        orm = self.create_orm()
+        # Each transaction reads from one replica, in turn.
+        self.assertEqual([[u"replica_0"], [u"replica_0"]], [self.names(orm) for _ in range(2)])
+        orm.session.commit()
+        self.assertEqual([[u"replica_1"], [u"replica_1"]], [self.names(orm) for _ in range(2)])
+        orm.session.rollback()
+        self.assertEqual([u"replica_0"], self.names(orm))
+        orm.session.close()
+        self.assertEqual([u"replica_1"], self.names(orm))
+
+    def test_writes_go_to_primary(self):
+        orm = self.create_orm()
+        # The lookup half reads from a replica, then the insert goes to the
+        # primary, and so does the rest of the transaction.
+        orm.get_or_create(orm.Thing, name = u"new")
+        self.assertEqual([u"primary", u"new"], self.names(orm))
+        orm.session.commit()
+        self.assertEqual([u"replica_1"], self.names(orm))
+
+    def test_read_your_writes(self):
+        orm = self.create_orm(read_your_writes = 60)
+        self.assertEqual([u"replica_0"], self.names(orm))
+        orm.get_or_create(orm.Thing, name = u"new")
+        orm.session.commit()
+        self.assertEqual([u"primary", u"new"], self.names(orm))
+        orm.session.commit()
+        self.assertEqual([u"primary", u"new"], self.names(orm))
+
+    def test_least_busy(self):
+        orm = self.create_orm(replica_selection = "least_busy")
+        replica_0 = orm.router.replicas[0]
+        with replica_0.connect():
+          self.assertEqual(1, orm.router.busy(replica_0))
+          self.assertEqual([[u"replica_1"], [u"replica_1"]], [self.names(orm) for _ in range(2)])
+        orm.session.commit()
+        self.assertEqual(0, orm.router.busy(replica_0))
+
+    def test_unknown_selection(self):
+        with self.assertRaises(ValueError):
+          self.create_orm(replica_selection = "nonsense")
+
+
 class TestGetOrCreateUniqueObject(unittest.TestCase):
     '''
     Tests and demonstrates ORM.get_or_create(self, mapped_class, **keyword_args).
@@ -245,6 +730,33 @@ class TestGetOrCreateUniqueObject(unittest.TestCase):
         with self.assertRaises(MultipleResultsFound):
           self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
 
+    def test_single_query_on_hit(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.orm.session.commit()
+        statements = []
+        event.listen(self.orm.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        thing2 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.assertEqual(thing1, thing2)
+        self.assertEqual(1, len(statements))
+
+    def test_rollback_discards_created(self):
+        # Objects are created within SAVEPOINTs, which mustn't commit them.
+        self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.orm.get_or_create_many(self.orm.Thing, [dict(name="Rapunzel")])
+        self.orm.session.rollback()
+        self.assertEqual(0, self.orm.session.query(self.orm.Thing).count())
+
+    def test_lookup_queries_cached(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        thing2 = self.orm.get_or_create(self.orm.Thing, name="Tom Tit Tot")
+        nameless = self.orm.get_or_create(self.orm.Thing, name=None)
+        # One query for names, one for missing names.
+        self.assertEqual(2, len(self.orm._lookup_queries))
+        self.assertEqual(thing1, self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+        self.assertEqual(thing2, self.orm.get_or_create(self.orm.Thing, name="Tom Tit Tot"))
+        self.assertEqual(nameless, self.orm.get_or_create(self.orm.Thing, name=None))
+        self.assertEqual(3, self.orm.session.query(self.orm.Thing).count())
+
     def test_attribute_error(self):
         # Can't uniquely identify a Thing object with nonsense attributes.
         with self.assertRaises(AttributeError):
@@ -253,6 +765,375 @@ class TestGetOrCreateUniqueObject(unittest.TestCase):
         thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
 
 
+class TestKeyCache(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM(..., key_cache_size, key_cache_ttl), which
+    caches the primary keys of objects found by get_or_create(...).
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False, key_cache_size = 2)
+        self.statements = []
+        event.listen(self.orm.engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+
+    def test_repeat_lookup_from_identity_map(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        del self.statements[:]
+        thing2 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.assertTrue(thing1 is thing2)
+        self.assertEqual([], self.statements)
+        self.assertEqual(dict(hits=1, misses=1, size=1), self.orm.key_cache.stats())
+
+    def test_invalidation(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.orm.session.delete(thing1)
+        self.orm.session.flush()
+        self.assertEqual(0, self.orm.key_cache.stats()["size"])
+        thing2 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.assertFalse(thing1 is thing2)
+        self.orm.session.rollback()
+        self.assertEqual(0, self.orm.key_cache.stats()["size"])
+        # Changed attributes no longer match cached keys.
+        thing3 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        thing3.name = "Tom Tit Tot"
+        thing4 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.assertFalse(thing3 is thing4)
+
+    def test_eviction(self):
+        now = [0.]
+        self.orm.key_cache.ttl = 10
+        self.orm.key_cache.clock = lambda: now[0]
+        for name in ["A", "B", "A", "C"]: self.orm.get_or_create(self.orm.Thing, name=name)
+        # "B" was least recently used.
+        self.orm.get_or_create(self.orm.Thing, name="A")
+        self.orm.get_or_create(self.orm.Thing, name="B")
+        self.assertEqual(dict(hits=2, misses=4, size=2), self.orm.key_cache.stats())
+        now[0] = 20.
+        self.orm.get_or_create(self.orm.Thing, name="B")
+        self.assertEqual(dict(hits=2, misses=5, size=2), self.orm.key_cache.stats())
+
+
+class TestStats(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM(..., instrument=True) and orm.stats(), which
+    report what the ORM did to its database.
+    '''
+    def setUp(self):
+        self.orm_defs = lambda: dict(
+          User = dict(
+            __tablename__ = 'users',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            addresses = relationship("Address"),
+          ),
+          Address = dict(
+            __tablename__ = 'addresses',
+            id = Column('id', Integer, primary_key = True),
+            user_id = Column('user_id', None, ForeignKey('users.id')),
+            email = Column('email', Text),
+            user = relationship("User"),
+          ),
+        )
+
+    def test_disabled(self):
+        orm = ORM(self.orm_defs(), 'sqlite:///:memory:', deferred_reflection = False)
+        self.assertEqual(None, orm.stats())
+
+    def test_stats(self):
+        orm = ORM(self.orm_defs(), 'sqlite:///:memory:', deferred_reflection = False, instrument = True, slow_query_threshold = 0)
+        for number in range(12):
+          orm.session.add(orm.User(name = u"User {}".format(number), addresses = [orm.Address(email = u"{}@domain.com".format(number))]))
+        orm.session.commit()
+        orm.reset_stats()
+        for user in orm.session.query(orm.User): user.addresses
+        orm.get_or_create(orm.User, name = u"User 12")
+        orm.session.flush()
+        stats = orm.stats()
+        # One query for users, twelve for their addresses, one lookup, and an
+        # insert within a SAVEPOINT.
+        self.assertEqual(17, stats["queries"]["count"])
+        self.assertEqual(17, sum(stats["queries"]["histogram"].values()))
+        self.assertEqual(12, stats["classes"]["Address"]["count"])
+        self.assertEqual(3, stats["classes"]["User"]["count"])
+        self.assertEqual(dict(User = 12, Address = 12), stats["rows"])
+        self.assertEqual(1, stats["flushes"]["count"])
+        self.assertEqual(17, len(stats["slow_queries"]))
+        self.assertEqual(["User.addresses lazily loaded 12 times in one session"], stats["n_plus_one"])
+        orm.reset_stats()
+        self.assertEqual(0, orm.stats()["queries"]["count"])
+        # Lazy loads are counted afresh after a reset.
+        orm.session.expire_all()
+        orm.session.query(orm.User).first().addresses
+        self.assertEqual({"User.addresses": 1}, orm.stats()["lazy_loads"])
+        self.assertEqual([], orm.stats()["n_plus_one"])
+
+
+class TestGetOrCreateConcurrently(unittest.TestCase):
+    '''
+    Tests that get_or_create(...) returns a concurrent writer's object, instead
+    of creating a duplicate, when the concurrent writer creates the object
+    between get_or_create(...)'s lookup and insert.
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'things.db')
+        metadata = MetaData()
+        Table('thing', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('name', Text, unique = True),
+        )
+        metadata.create_all(create_engine(url))
+        orm_defs = dict(Thing = dict(__tablename__ = 'thing'))
+        self.orm = ORM(orm_defs, url)
+        self.other_orm = ORM(orm_defs, url)
+
+    def tearDown(self):
+        self.orm.session.close()
+        self.other_orm.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_create(self):
+        def concurrent_writer(session, flush_context, instances):
+          # Sneak in just before the first flush.
+          if not self.other_orm.session.query(self.other_orm.Thing).count():
+            self.other_orm.get_or_create(self.other_orm.Thing, name=u"Rumplestiltskin")
+            self.other_orm.session.commit()
+        event.listen(self.orm.session, "before_flush", concurrent_writer)
+        thing = self.orm.get_or_create(self.orm.Thing, name=u"Rumplestiltskin")
+        self.orm.session.commit()
+        self.assertEqual(1, self.orm.session.query(self.orm.Thing).count())
+        self.assertEqual(u"Rumplestiltskin", thing.name)
+
+
+class TestGetOrCreateMany(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM.get_or_create_many(self, mapped_class, key_dicts, chunk_size).
+
+    get_or_create_many(...) behaves like calling get_or_create(...) once per
+    key dict, returning objects in input order, but looks up existing objects
+    in chunked "IN" queries and creates missing objects in one batch.
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            attribute = Column('attribute', Text),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+
+    def test_get_or_create_many(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin")
+        self.orm.session.commit()
+        key_dicts = [dict(name=name) for name in ("Rapunzel", "Rumplestiltskin", "Rapunzel", "Cinderella")]
+        things = self.orm.get_or_create_many(self.orm.Thing, key_dicts, chunk_size = 2)
+        self.assertEqual([u"Rapunzel", u"Rumplestiltskin", u"Rapunzel", u"Cinderella"], [thing.name for thing in things])
+        # Existing objects are found, and repeated keys yield the same object.
+        self.assertTrue(things[1] is thing1)
+        self.assertTrue(things[0] is things[2])
+        self.assertEqual(3, self.orm.session.query(self.orm.Thing).count())
+
+    def test_composite_and_null_keys(self):
+        thing1 = self.orm.get_or_create(self.orm.Thing, name="Mary", attribute="Contrary")
+        thing2 = self.orm.get_or_create(self.orm.Thing, name="Mary", attribute=None)
+        things = self.orm.get_or_create_many(self.orm.Thing, [
+          dict(name="Mary", attribute=None),
+          dict(name="Mary", attribute="Contrary"),
+          dict(name="Mary", attribute="Quite"),
+        ])
+        self.assertEqual([thing2, thing1], things[:2])
+        self.assertEqual(u"Quite", things[2].attribute)
+        self.assertEqual(3, self.orm.session.query(self.orm.Thing).count())
+
+    def test_relationship_keys(self):
+        orm_defs = dict(
+          User = dict(
+            __tablename__ = 'users',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+          ),
+          Address = dict(
+            __tablename__ = 'addresses',
+            id = Column('id', Integer, primary_key = True),
+            user_id = Column('user_id', Integer, ForeignKey('users.id')),
+            email = Column('email', Text),
+            user = relationship("User"),
+          ),
+        )
+        orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        user = orm.get_or_create(orm.User, name="Mary")
+        address = orm.get_or_create(orm.Address, user=user, email="mary@domain.com")
+        addresses = orm.get_or_create_many(orm.Address, [
+          dict(user=user, email="mary@domain.com"),
+          dict(user=user, email="contrary@domain.com"),
+        ])
+        self.assertTrue(addresses[0] is address)
+        self.assertEqual((user, u"contrary@domain.com"), (addresses[1].user, addresses[1].email))
+        self.assertEqual(2, orm.session.query(orm.Address).count())
+
+    def test_error_on_nonunique(self):
+        self.orm.session.add_all([self.orm.Thing(name="Rumplestiltskin"), self.orm.Thing(name="Rumplestiltskin")])
+        with self.assertRaises(MultipleResultsFound):
+          self.orm.get_or_create_many(self.orm.Thing, [dict(name="Rumplestiltskin")])
+
+    def test_attribute_error(self):
+        with self.assertRaises(AttributeError):
+          self.orm.get_or_create_many(self.orm.Thing, [dict(nonsense_attribute="Color of the sky")])
+        # Nearby negative control
+        self.orm.get_or_create_many(self.orm.Thing, [dict(name="Rumplestiltskin")])
+
+
+class TestStream(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM.stream(self, mapped_class, batch_size, **keyword_args).
+
+    stream(...) iterates over objects matching keyword arguments in lists of
+    up to batch_size objects, detaching each list once the next is requested.
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            color = Column('color', Text),
+          ),
+          Pair = dict(
+            __tablename__ = 'pair',
+            left = Column('left', Integer, primary_key = True),
+            right = Column('right', Integer, primary_key = True),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        for number in range(25):
+          self.orm.session.add(self.orm.Thing(name = u"Thing {}".format(number), color = u"Blue" if number % 5 else u"Red"))
+          self.orm.session.add(self.orm.Pair(left = number // 5, right = number % 5))
+        self.orm.session.commit()
+
+    def test_stream(self):
+        batches = []
+        for batch in self.orm.stream(self.orm.Thing, batch_size = 10):
+          # Earlier batches are detached.
+          self.assertTrue(all(inspect(thing).detached for batch in batches for thing in batch))
+          batches.append(batch)
+        self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+        self.assertEqual([u"Thing {}".format(number) for number in range(25)], [thing.name for batch in batches for thing in batch])
+
+    def test_stream_with_filter(self):
+        batches = list(self.orm.stream(self.orm.Thing, batch_size = 5, color = u"Red"))
+        self.assertEqual([5], [len(batch) for batch in batches])
+        self.assertEqual(set([u"Red"]), set(thing.color for thing in batches[0]))
+
+    def test_stream_composite_primary_key(self):
+        batches = list(self.orm.stream(self.orm.Pair, batch_size = 10))
+        self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+        self.assertEqual(25, len(set((pair.left, pair.right) for batch in batches for pair in batch)))
+
+
+class TestReadRows(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM.read_rows(self, mapped_class, **keyword_args),
+    which returns read-only named tuples instead of ORM objects.
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            color = Column('color', Text),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        for number in range(10):
+          self.orm.session.add(self.orm.Thing(name = u"Thing {}".format(number), color = u"Blue" if number % 5 else None))
+        self.orm.session.commit()
+        self.orm.remove_session()
+
+    def test_read_rows(self):
+        rows = self.orm.read_rows(self.orm.Thing, color = u"Blue")
+        self.assertEqual(8, len(rows))
+        self.assertEqual(("id", "name", "color"), rows[0]._fields)
+        self.assertEqual((2, u"Thing 1", u"Blue"), tuple(rows[0]))
+        self.assertEqual(u"Thing 1", rows[0].name)
+        # Rows aren't tracked by the session.
+        self.assertEqual(0, len(self.orm.session.identity_map))
+        self.assertEqual(type(rows[0]), type(self.orm.read_rows(self.orm.Thing)[0]))
+
+    def test_read_rows_with_none(self):
+        rows = self.orm.read_rows(self.orm.Thing, color = None)
+        self.assertEqual([u"Thing 0", u"Thing 5"], [row.name for row in rows])
+
+    def test_attribute_error(self):
+        with self.assertRaises(AttributeError):
+          self.orm.read_rows(self.orm.Thing, nonsense_attribute = u"Color of the sky")
+
+
+class TestBulkLoad(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM.bulk_load(self, mapped_class, rows, chunk_size, commit_every, progress),
+    and ORM.bulk_load_csv(self, mapped_class, path, null, **keyword_args).
+
+    bulk_load(...) inserts dicts keyed by column name into the table of
+    mapped_class, chunk_size rows per executemany() call, without creating
+    objects.
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            color = Column('color', Text),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+
+    def test_bulk_load(self):
+        rows = (dict(name = u"Thing {}".format(number), color = u"Blue") for number in range(2500))
+        progress = []
+        stats = self.orm.bulk_load(self.orm.Thing, rows, chunk_size = 1000, commit_every = 2000, progress = progress.append)
+        self.assertEqual(2500, stats["rows"])
+        self.assertEqual([1000, 2000, 2500], [p["rows"] for p in progress])
+        self.assertFalse(self.orm.session.in_transaction())
+        self.assertEqual(2500, self.orm.session.query(self.orm.Thing).filter_by(color = u"Blue").count())
+
+    def test_different_keys(self):
+        # Rows of a chunk may have different keys.
+        rows = [dict(name = u"Thing 0"), dict(name = u"Thing 1", color = u"Blue"), dict(color = u"Red"), dict(name = u"Thing 3")]
+        self.assertEqual(4, self.orm.bulk_load(self.orm.Thing, rows)["rows"])
+        self.assertEqual(
+          [(u"Thing 0", None), (u"Thing 1", u"Blue"), (None, u"Red"), (u"Thing 3", None)],
+          [(t.name, t.color) for t in self.orm.session.query(self.orm.Thing).order_by(self.orm.Thing.id)],
+        )
+
+    def test_unknown_column(self):
+        with self.assertRaises(AttributeError):
+          self.orm.bulk_load(self.orm.Thing, [dict(name = u"Thing"), dict(nonsense_column = u"Blue")])
+        self.assertEqual(0, self.orm.session.query(self.orm.Thing).count())
+
+    def test_bulk_load_csv(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+          path = os.path.join(tmpdir, "things.csv")
+          with open(path, "w") as csv_file:
+            csv_file.write("name,color\nRumplestiltskin,Gold\nRapunzel,\n")
+          stats = self.orm.bulk_load_csv(self.orm.Thing, path)
+        finally:
+          shutil.rmtree(tmpdir)
+        self.assertEqual(2, stats["rows"])
+        things = self.orm.session.query(self.orm.Thing).order_by(self.orm.Thing.id).all()
+        self.assertEqual([(u"Rumplestiltskin", u"Gold"), (u"Rapunzel", None)], [(t.name, t.color) for t in things])
+
+
 class TestGetOrCreateAndUpdate(unittest.TestCase):
     '''
     Tests and demonstrates ORM.get_or_create_and_update(self, mapped_class, query_dict, update_dict).
@@ -312,5 +1193,400 @@ class TestGetOrCreateAndUpdate(unittest.TestCase):
         self.assertEqual(thing_1.attribute, "Meanness")
         self.assertEqual(thing_1, thing_2)
 
+    def test_create_with_required_attribute(self):
+        # Created objects get their update before being inserted, so update
+        # dicts can supply columns the database requires.
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            attribute = Column('attribute', Text, nullable = False),
+          ),
+        )
+        orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        thing = orm.get_or_create_and_update(orm.Thing, dict(name="Rumplestiltskin"), dict(attribute="Sneakiness"))
+        self.assertEqual(thing.attribute, "Sneakiness")
+
+
+class TestBatch(unittest.TestCase):
+    '''
+    Tests and demonstrates ORM.batch(self, size), which buffers
+    get_or_create_and_update(...) calls and writes them in batches.
+    '''
+    def setUp(self):
+        self.orm_defs = lambda: dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+            attribute = Column('attribute', Text),
+          ),
+        )
+        self.calls = [(dict(name = u"Thing {}".format(number % 50)), dict(attribute = u"Attribute {}".format(number))) for number in range(120)]
+        self.calls.append((dict(name = None), dict(attribute = u"Nameless")))
+
+    def run_calls(self, batch_size = None):
+        orm = ORM(self.orm_defs(), 'sqlite:///:memory:', deferred_reflection = False)
+        for number in range(0, 50, 3):
+          orm.get_or_create(orm.Thing, name = u"Thing {}".format(number))
+        orm.session.commit()
+        statements = []
+        event.listen(orm.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        if batch_size is None:
+          for query_dict, update_dict in self.calls: orm.get_or_create_and_update(orm.Thing, query_dict, update_dict)
+        else:
+          with orm.batch(size = batch_size):
+            for query_dict, update_dict in self.calls: orm.get_or_create_and_update(orm.Thing, query_dict, update_dict)
+        orm.session.commit()
+        things = [(t.name, t.attribute) for t in orm.session.query(orm.Thing).order_by(orm.Thing.name)]
+        return things, statements
+
+    def test_batch_matches_unbatched(self):
+        unbatched_things, unbatched_statements = self.run_calls()
+        batched_things, batched_statements = self.run_calls(batch_size = 5000)
+        self.assertEqual(unbatched_things, batched_things)
+        self.assertEqual(51, len(batched_things))
+        self.assertTrue(len(batched_statements) < 10)
+        self.assertTrue(len(batched_statements) * 10 < len(unbatched_statements))
+
+    def test_small_batches(self):
+        unbatched_things, _ = self.run_calls()
+        batched_things, _ = self.run_calls(batch_size = 7)
+        self.assertEqual(unbatched_things, batched_things)
+
+    def test_errors(self):
+        orm = ORM(self.orm_defs(), 'sqlite:///:memory:', deferred_reflection = False)
+        with self.assertRaises(AttributeError):
+          with orm.batch():
+            orm.get_or_create_and_update(orm.Thing, dict(name = u"Thing"), dict(nonsense_attribute = u"Blue"))
+        orm.session.add_all([orm.Thing(name = u"Thing"), orm.Thing(name = u"Thing")])
+        with self.assertRaises(MultipleResultsFound):
+          with orm.batch():
+            orm.get_or_create_and_update(orm.Thing, dict(name = u"Thing"), dict(attribute = u"Blue"))
+
+    def test_batch_per_session(self):
+        # Another thread's session isn't buffered by this thread's batch.
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        orm = ORM(self.orm_defs(), 'sqlite:///' + os.path.join(tmpdir, 'test.db'), deferred_reflection = False, session_scope = "thread")
+        self.addCleanup(orm.engine.dispose)
+        results = []
+        def other_thread():
+            thing = orm.get_or_create_and_update(orm.Thing, dict(name = u"Other"), dict(attribute = u"Blue"))
+            results.append(thing.attribute if thing is not None else None)
+            orm.session.commit()
+            orm.remove_session()
+        with orm.batch():
+          self.assertEqual(None, orm.get_or_create_and_update(orm.Thing, dict(name = u"Thing"), dict(attribute = u"Blue")))
+          thread = threading.Thread(target = other_thread)
+          thread.start()
+          thread.join()
+        orm.session.commit()
+        self.assertEqual([u"Blue"], results)
+        self.assertEqual([u"Other", u"Thing"], [t.name for t in orm.session.query(orm.Thing).order_by(orm.Thing.name)])
+        orm.remove_session()
+
+
+class TestUpsert(unittest.TestCase):
+    '''
+    Tests and demonstrates the upsert mode of ORM.get_or_create_and_update(...),
+    and ORM.upsert_many(self, mapped_class, query_and_update_dicts).
+
+    In upsert mode, objects are created or updated with a single "INSERT ... ON
+    CONFLICT DO UPDATE" statement, which requires a unique constraint on the
+    columns named in the query dict.
+    '''
+    def setUp(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text, unique = True),
+            attribute = Column('attribute', Text),
+          ),
+        )
+        self.orm = ORM(orm_defs, 'sqlite:///:memory:', deferred_reflection = False)
+        self.statements = []
+        event.listen(self.orm.engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+
+    def test_upsert(self):
+        query_dict = dict(name="Rumplestiltskin")
+        thing_1 = self.orm.get_or_create_and_update(self.orm.Thing, query_dict, dict(attribute="Sneakiness"), upsert = True)
+        self.assertEqual(thing_1.attribute, "Sneakiness")
+        thing_2 = self.orm.get_or_create_and_update(self.orm.Thing, query_dict, dict(attribute="Meanness"), upsert = True)
+        self.assertEqual(thing_1, thing_2)
+        self.assertEqual(thing_1.attribute, "Meanness")
+        self.assertEqual(1, self.orm.session.query(self.orm.Thing).count())
+        self.assertEqual(2, len([statement for statement in self.statements if "ON CONFLICT" in statement]))
+
+    def test_upsert_many(self):
+        thing = self.orm.get_or_create_and_update(self.orm.Thing, dict(name="Rumplestiltskin"), dict(attribute="Sneakiness"))
+        self.orm.session.commit()
+        del self.statements[:]
+        self.orm.upsert_many(self.orm.Thing, [
+          (dict(name="Rumplestiltskin"), dict(attribute="Meanness")),
+          (dict(name="Rapunzel"), dict(attribute="Hairiness")),
+          (dict(name="Cinderella"), dict()),
+        ])
+        # One statement per distinct pair of query and update keys.
+        self.assertEqual(2, len(self.statements))
+        self.assertEqual(thing.attribute, "Meanness")
+        self.assertEqual(
+          [(u"Cinderella", None), (u"Rapunzel", u"Hairiness"), (u"Rumplestiltskin", u"Meanness")],
+          [(t.name, t.attribute) for t in self.orm.session.query(self.orm.Thing).order_by(self.orm.Thing.name)],
+        )
+
+    def test_upsert_null(self):
+        # NULLs never conflict, so query dicts with None values aren't upserted.
+        thing_1 = self.orm.get_or_create_and_update(self.orm.Thing, dict(name=None), dict(attribute="Sneakiness"), upsert = True)
+        thing_2 = self.orm.get_or_create_and_update(self.orm.Thing, dict(name=None), dict(attribute="Meanness"), upsert = True)
+        self.assertEqual(thing_1, thing_2)
+        self.assertEqual(thing_1.attribute, "Meanness")
+        self.orm.upsert_many(self.orm.Thing, [
+          (dict(name=None), dict(attribute="Hairiness")),
+          (dict(name="Rapunzel"), dict(attribute="Hairiness")),
+        ])
+        self.assertEqual(thing_1.attribute, "Hairiness")
+        self.assertEqual(2, self.orm.session.query(self.orm.Thing).count())
+        self.assertEqual(1, len([statement for statement in self.statements if "ON CONFLICT" in statement]))
+
+    def test_attribute_error(self):
+        with self.assertRaises(AttributeError):
+          self.orm.get_or_create_and_update(self.orm.Thing, dict(name="Rumplestiltskin"), dict(nonsense_attribute="Blue"), upsert = True)
+        # Nearby negative control
+        self.orm.get_or_create_and_update(self.orm.Thing, dict(name="Rumplestiltskin"), dict(attribute="Blue"), upsert = True)
+
+
+@unittest.skipIf(AsyncORM is None, "requires Python 3, SQLAlchemy's asyncio extension, and aiosqlite")
+class TestAsyncORM(unittest.TestCase):
+    '''
+    Tests and demonstrates AsyncORM, whose get_or_create(...) and
+    get_or_create_and_update(...) must be awaited.
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'things.db')
+        metadata = MetaData()
+        Table('thing', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('name', Text),
+          Column('attribute', Text),
+        )
+        metadata.create_all(create_engine(url))
+        self.orm = AsyncORM(dict(Thing = dict(__tablename__ = 'thing')))
+        self.loop = asyncio.new_event_loop()
+        self.wait(self.orm.create_engine(url.replace('sqlite://', 'sqlite+aiosqlite://')))
+
+    def tearDown(self):
+        self.wait(self.orm.remove_session())
+        self.wait(self.orm.engine.dispose())
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def count(self):
+        return len(self.wait(self.orm.session.execute(select(self.orm.Thing))).scalars().all())
+
+    def test_get_or_create(self):
+        thing1 = self.wait(self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+        self.wait(self.orm.session.commit())
+        thing2 = self.wait(self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+        self.assertTrue(thing1 is thing2)
+        self.assertEqual(1, self.count())
+        self.orm.session.add(self.orm.Thing(name="Rumplestiltskin"))
+        with self.assertRaises(MultipleResultsFound):
+          self.wait(self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+
+    def test_rollback_discards_created(self):
+        self.wait(self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+        self.wait(self.orm.session.rollback())
+        self.assertEqual(0, self.count())
+
+    def test_get_or_create_and_update(self):
+        query_dict = dict(name="Rumplestiltskin")
+        thing1 = self.wait(self.orm.get_or_create_and_update(self.orm.Thing, query_dict, dict(attribute="Sneakiness")))
+        thing2 = self.wait(self.orm.get_or_create_and_update(self.orm.Thing, query_dict, dict(attribute="Meanness")))
+        self.assertTrue(thing1 is thing2)
+        self.assertEqual(thing1.attribute, "Meanness")
+        with self.assertRaises(AttributeError):
+          self.wait(self.orm.get_or_create_and_update(self.orm.Thing, query_dict, dict(nonsense_attribute="Blue")))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork()")
+    def test_fork(self):
+        self.wait(self.orm.get_or_create(self.orm.Thing, name="Rumplestiltskin"))
+        self.wait(self.orm.session.commit())
+        parent_session = self.orm.session
+        pid = os.fork()
+        if pid == 0:
+          # The child gets its own session and connections.
+          try:
+            ok = self.orm.session is not parent_session and self.count() == 1
+          except Exception:
+            ok = False
+          os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertTrue(self.orm.session is parent_session)
+        self.assertEqual(1, self.count())
+
+    def test_synchronous_helpers(self):
+        with self.assertRaises(TypeError):
+          self.orm.stream(self.orm.Thing)
+        with self.assertRaises(TypeError):
+          self.orm.bulk_load(self.orm.Thing, [dict(name="Rumplestiltskin")])
+        with self.assertRaises(TypeError):
+          with self.orm.batch():
+            pass
+        with self.assertRaises(TypeError):
+          self.orm.refresh_schema()
+        self.assertEqual(0, self.count())
+
+    def test_in_memory_database(self):
+        orm_defs = dict(
+          Thing = dict(
+            __tablename__ = 'thing',
+            id = Column('id', Integer, primary_key = True),
+            name = Column('name', Text),
+          ),
+        )
+        orm = AsyncORM(orm_defs, deferred_reflection = False)
+        self.wait(orm.create_engine('sqlite+aiosqlite:///:memory:'))
+        try:
+          thing1 = self.wait(orm.get_or_create(orm.Thing, name="Rumplestiltskin"))
+          thing2 = self.wait(orm.get_or_create(orm.Thing, name="Rumplestiltskin"))
+          self.assertTrue(thing1 is thing2)
+        finally:
+          self.wait(orm.remove_session())
+          self.wait(orm.engine.dispose())
+
+
+class TestProcesses(unittest.TestCase):
+    '''
+    Tests and demonstrates use of ORMs in other processes: forked, given
+    pickled ORMs, or mapping functions over partitions of tables by
+    ORM.map_partitions(self, mapped_class, function, partitions, processes).
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tmpdir, 'test.db')
+        metadata = MetaData()
+        thing = Table('thing', metadata,
+          Column('id', Integer, primary_key = True),
+          Column('name', Text),
+        )
+        engine = create_engine(self.url)
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+          connection.execute(thing.insert(), [dict(name = u"x" * (number % 7)) for number in range(100)])
+        engine.dispose()
+        self.orm = ORM(thing_defs, self.url, reflection_cache = os.path.join(self.tmpdir, 'reflection.cache'))
+
+    def tearDown(self):
+        self.orm.remove_session()
+        self.orm.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pickle(self):
+        orm = pickle.loads(pickle.dumps(self.orm))
+        self.assertFalse(orm is self.orm)
+        self.assertEqual(self.url, str(orm.engine.url))
+        self.assertEqual(self.orm.reflection_cache, orm.reflection_cache)
+        self.assertEqual(100, orm.session.query(orm.Thing).count())
+        orm.remove_session()
+        orm.engine.dispose()
+
+    def test_pickle_classes_created_later(self):
+        # Classes created after construction are rebuilt too.
+        orm = ORM()
+        orm.create_mapped_classes(thing_defs)
+        orm.create_engine(self.url)
+        unpickled = pickle.loads(pickle.dumps(orm))
+        self.assertEqual(100, unpickled.session.query(unpickled.Thing).count())
+        for each in (orm, unpickled):
+          each.remove_session()
+          each.engine.dispose()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork()")
+    def test_fork(self):
+        parent_session = self.orm.session
+        self.assertEqual(100, parent_session.query(self.orm.Thing).count())
+        pid = os.fork()
+        if pid == 0:
+          # The child gets its own session and connections.
+          try:
+            ok = self.orm.session is not parent_session and self.orm.session.query(self.orm.Thing).count() == 100
+          except Exception:
+            ok = False
+          os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertTrue(self.orm.session is parent_session)
+        self.assertEqual(100, parent_session.query(self.orm.Thing).count())
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork()")
+    def test_fork_engine(self):
+        # Children don't use the parent's pooled connections, even without
+        # sessions.
+        orm = ORM(thing_defs, self.url, engine_options = dict(poolclass = QueuePool))
+        self.addCleanup(orm.engine.dispose)
+        with orm.engine.connect() as connection:
+          parent_connection = connection.connection.dbapi_connection
+        pid = os.fork()
+        if pid == 0:
+          try:
+            orm.refresh_schema()
+            with orm.engine.connect() as connection:
+              ok = connection.connection.dbapi_connection is not parent_connection
+          except Exception:
+            ok = False
+          os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        with orm.engine.connect() as connection:
+          self.assertTrue(connection.connection.dbapi_connection is parent_connection)
+
+    def test_map_partitions(self):
+        results = self.orm.map_partitions(self.orm.Thing, name_lengths, partitions = 4, processes = 2)
+        self.assertEqual(4, len(results))
+        self.assertEqual([number % 7 for number in range(100)], [length for result in results for length in result])
+        results = self.orm.map_partitions(self.orm.Thing, name_lengths, processes = 2, name = u"xx")
+        self.assertEqual([2] * 14, [length for result in results for length in result])
+
+
+class TestBenchmarks(unittest.TestCase):
+    '''
+    Tests the benchmark suite in irrealis_orm.benchmarks, at tiny sizes.
+    '''
+    def test_run_suite(self):
+        results = benchmarks.run_suite(tables = (2,), rows = (10,), definitions = (3,), lookups = 5, repeat = 1)
+        self.assertEqual(set([
+          "construction/tables=2",
+          "get_or_create_hit/rows=10",
+          "get_or_create_miss/rows=10",
+          "get_or_create_and_update/rows=10",
+          "create_mapped_classes/definitions=3",
+        ]), set(results))
+        self.assertEqual("seconds", results["construction/tables=2"]["unit"])
+        self.assertEqual("per_second", results["get_or_create_hit/rows=10"]["unit"])
+
+    def test_compare(self):
+        baseline = dict(
+          slower = dict(value = 1., unit = "seconds"),
+          fewer = dict(value = 100., unit = "per_second"),
+          steady = dict(value = 1., unit = "seconds"),
+          dropped = dict(value = 1., unit = "seconds"),
+        )
+        results = dict(
+          slower = dict(value = 1.5, unit = "seconds"),
+          fewer = dict(value = 70., unit = "per_second"),
+          steady = dict(value = 1.1, unit = "seconds"),
+          added = dict(value = 1., unit = "seconds"),
+        )
+        self.assertEqual([("fewer", 100., 70.), ("slower", 1., 1.5)], benchmarks.compare(baseline, results, 0.2))
+        self.assertEqual([], benchmarks.compare(baseline, results, 0.5))
+
 
 if __name__ == "__main__": unittest.main()
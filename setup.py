@@ -19,8 +19,12 @@ Tool to quickly setup SQLAlchemy object relation mappings""",
       zip_safe=False,
       install_requires=[
           # -*- Extra requirements: -*-
-          "SQLAlchemy>=0.8.2",
+          "SQLAlchemy>=1.4.33",
       ],
+      extras_require={
+          # For irrealis_orm.async_orm.AsyncORM.
+          "asyncio": ["SQLAlchemy[asyncio]>=1.4.33"],
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,